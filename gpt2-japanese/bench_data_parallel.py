@@ -0,0 +1,68 @@
+import re
+import sys
+import argparse
+import subprocess
+
+parser = argparse.ArgumentParser(
+    description="Training throughput of run_finetune.py from 1 to N workers. "
+    "Other arguments are passed to run_finetune.py, e.g. --batch_size 2.",
+    formatter_class=argparse.ArgumentDefaultsHelpFormatter,
+)
+parser.add_argument("--dataset", type=str, required=True)
+parser.add_argument("--base_model", type=str, default="gpt2ja-small")
+parser.add_argument(
+    "--max_workers", type=int, default=4, help="Benchmark 1, 2, 4, ... workers"
+)
+parser.add_argument("--num_iter", type=int, default=10)
+
+
+def run(args, finetune_args, num_workers):
+    output = subprocess.run(
+        [
+            sys.executable,
+            "gpt2-japanese/run_finetune.py",
+            "--dataset",
+            args.dataset,
+            "--base_model",
+            args.base_model,
+            "--num_iter",
+            str(args.num_iter),
+            "--num_workers",
+            str(num_workers),
+            "--run_name",
+            "bench_data_parallel",
+            "--save_every",
+            str(args.num_iter + 2),
+            "--gpu",
+            "-1",
+        ]
+        + finetune_args,
+        capture_output=True,
+        check=True,
+    ).stdout.decode()
+    return float(re.search(r"worker\(s\): ([\d.]+) tokens/s", output).group(1))
+
+
+def main():
+    args, finetune_args = parser.parse_known_args()
+
+    num_workers = [1]
+    while num_workers[-1] * 2 <= args.max_workers:
+        num_workers.append(num_workers[-1] * 2)
+    if num_workers[-1] != args.max_workers:
+        num_workers.append(args.max_workers)
+
+    print("workers  tokens/s  speedup  efficiency")
+    base = None
+    for n in num_workers:
+        tps = run(args, finetune_args, n)
+        base = base or tps
+        print(
+            "{n:7d} {tps:9.0f} {speedup:8.2f} {eff:10.0%}".format(
+                n=n, tps=tps, speedup=tps / base, eff=tps / base / n
+            )
+        )
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,91 @@
+import os
+import json
+import time
+import argparse
+
+from encode_bpe import BPEEncoder_ja, load_encoder
+
+parser = argparse.ArgumentParser(
+    description="Micro-benchmark of the BPEEncoder_ja text pipeline.",
+    formatter_class=argparse.ArgumentDefaultsHelpFormatter,
+)
+parser.add_argument(
+    "--src_dir", type=str, default="sample_texts", help="Directory of .txt files"
+)
+parser.add_argument(
+    "--repeat", type=int, default=3, help="Best of N runs is reported per stage"
+)
+
+
+def load_documents(src_dir):
+    documents = []
+    for curDir, dirs, files in os.walk(src_dir):
+        for file in sorted(files):
+            if file.endswith(".txt"):
+                with open(os.path.join(curDir, file), "r", encoding="utf-8") as fp:
+                    documents.extend(
+                        d for d in fp.read().split("<|endoftext|>") if d.strip()
+                    )
+    return documents
+
+
+def bench(name, fn, inputs, n_bytes, repeat):
+    """Report the best of `repeat` runs, with throughput in source text bytes."""
+    best = float("inf")
+    for _ in range(repeat):
+        start = time.perf_counter()
+        for x in inputs:
+            fn(x)
+        best = min(best, time.perf_counter() - start)
+    print(
+        "{name:<12} {us:9.1f} us/doc {mbps:8.2f} MB/s".format(
+            name=name,
+            us=best / len(inputs) * 1e6,
+            mbps=n_bytes / best / 1e6,
+        )
+    )
+
+
+def main():
+    args = parser.parse_args()
+
+    with open("gpt2-japanese/ja-bpe.txt", encoding="utf-8") as f:
+        bpe = f.read().split("\n")
+
+    with open("gpt2-japanese/emoji.json", encoding="utf-8") as f:
+        emoji = json.loads(f.read())
+
+    start = time.perf_counter()
+    BPEEncoder_ja(bpe, emoji)
+    print("compile      {:9.1f} ms".format((time.perf_counter() - start) * 1e3))
+
+    load_encoder()  # make sure the precompiled tables exist
+    start = time.perf_counter()
+    enc = load_encoder()
+    print("load         {:9.1f} ms".format((time.perf_counter() - start) * 1e3))
+
+    documents = load_documents(args.src_dir)
+    if not documents:
+        raise ValueError("no documents found in %s" % args.src_dir)
+    print("documents    {:9d}".format(len(documents)))
+
+    n_bytes = sum(len(d.encode("utf-8")) for d in documents)
+    normalized = [enc.normalizer.normalize(d) for d in documents]
+    tokens = [enc.encode(d) for d in documents]
+
+    bench("normalize", enc.normalizer.normalize, documents, n_bytes, args.repeat)
+    bench("emoji", enc.replace_emoji, normalized, n_bytes, args.repeat)
+    bench("clean", enc.clean_text, normalized, n_bytes, args.repeat)
+    bench("encode", enc.encode, documents, n_bytes, args.repeat)
+    bench(
+        "encode+clean",
+        lambda d: enc.encode(d, clean=True),
+        documents,
+        n_bytes,
+        args.repeat,
+    )
+    bench("decode", enc.decode, tokens, n_bytes, args.repeat)
+
+
+if __name__ == "__main__":
+    main()
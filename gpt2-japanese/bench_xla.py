@@ -0,0 +1,145 @@
+import os
+import json
+import time
+import argparse
+
+os.environ["TF_CPP_MIN_LOG_LEVEL"] = "2"
+
+import numpy as np
+import tensorflow._api.v2.compat.v1 as tf
+
+import model
+from model import HParams as HParams
+from sampling import sample_sequence
+from encode_bpe import load_encoder
+
+tf.get_logger().setLevel("ERROR")
+
+PRESETS = {
+    "small": {"n_ctx": 1024, "n_embd": 768, "n_head": 12, "n_layer": 12},
+    "medium": {"n_ctx": 1024, "n_embd": 1024, "n_head": 16, "n_layer": 24},
+    "large": {"n_ctx": 1024, "n_embd": 1280, "n_head": 20, "n_layer": 36},
+}
+
+parser = argparse.ArgumentParser(
+    description="Step times of the training step and the sampling loop, run as "
+    "a plain TensorFlow graph and compiled with XLA, on randomly initialized "
+    "models.",
+    formatter_class=argparse.ArgumentDefaultsHelpFormatter,
+)
+parser.add_argument(
+    "--sizes",
+    type=str,
+    default="small,medium,large",
+    help="Comma-separated presets (small, medium, large) or model directories "
+    "with a hparams.json",
+)
+parser.add_argument("--batch_size", type=int, default=1)
+parser.add_argument("--seq_len", type=int, default=256, help="Training tokens per row")
+parser.add_argument("--context_len", type=int, default=16)
+parser.add_argument("--length", type=int, default=64, help="Sampled tokens")
+parser.add_argument("--repeat", type=int, default=5, help="Timed runs, best is kept")
+parser.add_argument("--gpu", default="-1", help="visible gpu number.")
+
+
+def load_hparams(size, n_vocab):
+    if size in PRESETS:
+        return HParams(n_vocab=n_vocab, **PRESETS[size])
+    with open(os.path.join(size, "hparams.json"), encoding="utf-8") as f:
+        return HParams(**json.loads(f.read()))
+
+
+def best_time(sess, fetches, feed_dict, repeat):
+    """Return (first call - best call, best of `repeat` calls) in seconds.
+    The first call includes the XLA compilation."""
+    start = time.perf_counter()
+    sess.run(fetches, feed_dict=feed_dict)
+    first = time.perf_counter() - start
+    best = float("inf")
+    for _ in range(repeat):
+        start = time.perf_counter()
+        sess.run(fetches, feed_dict=feed_dict)
+        best = min(best, time.perf_counter() - start)
+    return max(first - best, 0.0), best
+
+
+def bench(hparams, xla, args, config):
+    length = min(args.length, hparams.n_ctx - args.context_len)
+    rng = np.random.RandomState(0)
+    results = {}
+    with tf.Session(config=config, graph=tf.Graph()) as sess:
+        context = tf.placeholder(tf.int32, [args.batch_size, None])
+        with model.jit_scope(xla):
+            output = model.model(hparams=hparams, X=context)
+            loss = tf.reduce_mean(
+                tf.nn.sparse_softmax_cross_entropy_with_logits(
+                    labels=context[:, 1:], logits=output["logits"][:, :-1]
+                )
+            )
+        train_op = tf.train.GradientDescentOptimizer(1e-5).minimize(loss)
+        sess.run(tf.global_variables_initializer())
+        tokens = rng.randint(
+            0, hparams.n_vocab, (args.batch_size, min(args.seq_len, hparams.n_ctx))
+        )
+        results["train"] = best_time(sess, train_op, {context: tokens}, args.repeat)
+
+    with tf.Session(config=config, graph=tf.Graph()) as sess:
+        context = tf.placeholder(tf.int32, [1, None])
+        output = sample_sequence(
+            hparams=hparams,
+            length=length,
+            context=context,
+            batch_size=1,
+            top_k=40,
+            xla=xla,
+        )
+        sess.run(tf.global_variables_initializer())
+        tokens = rng.randint(0, hparams.n_vocab, (1, args.context_len))
+        compile_time, best = best_time(sess, output, {context: tokens}, args.repeat)
+        results["sample"] = (compile_time, best / length)
+    return results
+
+
+def main():
+    args = parser.parse_args()
+    n_vocab = len(load_encoder())
+
+    config = tf.ConfigProto()
+    if int(args.gpu) >= 0:
+        config.gpu_options.allow_growth = True
+        config.gpu_options.visible_device_list = args.gpu
+
+    print(
+        "{:<8} {:<6} {:>10} {:>14} {:>10} {:>15} {:>10}".format(
+            "model",
+            "mode",
+            "compile s",
+            "train step ms",
+            "speedup",
+            "sample ms/tok",
+            "speedup",
+        )
+    )
+    for size in args.sizes.split(","):
+        hparams = load_hparams(size, n_vocab)
+        plain = None
+        for xla in (False, True):
+            results = bench(hparams, xla, args, config)
+            train_compile, train_best = results["train"]
+            sample_compile, sample_best = results["sample"]
+            plain = plain or (train_best, sample_best)
+            print(
+                "{:<8} {:<6} {:>10.1f} {:>14.1f} {:>9.2f}x {:>15.2f} {:>9.2f}x".format(
+                    os.path.basename(size.rstrip("/")),
+                    "xla" if xla else "graph",
+                    train_compile + sample_compile,
+                    train_best * 1e3,
+                    plain[0] / train_best,
+                    sample_best * 1e3,
+                    plain[1] / sample_best,
+                )
+            )
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,216 @@
+import os
+import re
+import sys
+import json
+import argparse
+
+import jaconv
+import numpy as np
+
+from encode_bpe import load_encoder
+
+parser = argparse.ArgumentParser(
+    description="Check that BPEEncoder_ja encodes and decodes exactly like the "
+    "original slicing encoder, on every .txt file of a directory.",
+    formatter_class=argparse.ArgumentDefaultsHelpFormatter,
+)
+parser.add_argument(
+    "--src_dir", type=str, default="sample_texts", help="Directory of .txt files"
+)
+parser.add_argument(
+    "--num_random", type=int, default=1000, help="Random token sequences to decode"
+)
+parser.add_argument("--seed", type=int, default=0)
+
+
+class ReferenceEncoder:
+    """The original BPEEncoder_ja, kept as the reference for the fast one."""
+
+    def __init__(self, bpe, emoji):
+        self.bpe = bpe
+        self.bpe_idx = {k: v for v, k in enumerate(bpe)}
+        self.emoji = emoji
+        self.maxlen = np.max([len(w) for w in self.bpe])
+        self.content_repatter1 = re.compile(
+            r"(https?|ftp)(:\/\/[-_\.!~*\'()a-zA-Z0-9;\/?:\@&=\+$,%#]+)"
+        )
+        self.content_repatter2 = re.compile(
+            r"[A-Za-z0-9\._+]*@[\-_0-9A-Za-z]+(\.[A-Za-z]+)*"
+        )
+        self.content_repatter3 = re.compile(
+            r"[\(]{0,1}[0-9]{2,4}[\)\-\(]{0,1}[0-9]{2,4}[\)\-]{0,1}[0-9]{3,4}"
+        )
+        self.content_repatter4 = re.compile(
+            r"([12]\d{3}[/\-年])*(0?[1-9]|1[0-2])[/\-月]((0?[1-9]|[12][0-9]|3[01])日?)*(\d{1,2}|:|\d{1,2}時|\d{1,2}分|\(日\)|\(月\)|\(火\)|\(水\)|\(木\)|\(金\)|\(土\))*"
+        )
+        self.content_repatter5 = re.compile(
+            r"(明治|大正|昭和|平成|令和)\d{1,2}年(0?[1-9]|1[0-2])月(0?[1-9]|[12][0-9]|3[01])日(\d{1,2}|:|\d{1,2}時|\d{1,2}分|\(日\)|\(月\)|\(火\)|\(水\)|\(木\)|\(金\)|\(土\))*"
+        )
+        self.content_repatter6 = re.compile(
+            r"((0|[1-9]\d*|[1-9]\d{0,2}(,\d{3})+)*億)*((0|[1-9]\d*|[1-9]\d{0,2}(,\d{3})+)*万)*((0|[1-9]\d*|[1-9]\d{0,2}(,\d{3})+)*千)*(0|[1-9]\d*|[1-9]\d{0,2}(,\d{3})+)*(千円|万円|千万円|円|千ドル|万ドル|千万ドル|ドル|千ユーロ|万ユーロ|千万ユーロ|ユーロ)+(\(税込\)|\(税抜\)|\+tax)*"
+        )
+
+    def clean_text(self, content):
+        content = jaconv.z2h(content, kana=False, digit=True, ascii=True)
+        content = self.content_repatter1.sub("<URL>", content)
+        content = self.content_repatter2.sub("<EMAIL>", content)
+        content = self.content_repatter3.sub("<TEL>", content)
+        content = self.content_repatter4.sub("<DATE>", content)
+        content = self.content_repatter5.sub("<DATE>", content)
+        content = self.content_repatter6.sub("<PRICE>", content)
+        return content
+
+    def encode(self, text, clean=False):
+        text = text.replace(" ", "<SP>")
+        text = text.replace("　", "<SP>")
+        text = text.replace("\r\n", "<BR>")
+        text = text.replace("\n", "<BR>")
+        text = text.replace("\r", "<BR>")
+        text = text.replace("\t", "<TAB>")
+        text = text.replace("—", "ー")
+        text = text.replace("−", "ー")
+        for k, v in self.emoji["emoji"].items():
+            if k in text:
+                text = text.replace(k, v)
+        if clean:
+            text = self.clean_text(text)
+        pos = 0
+        result = []
+        while pos < len(text):
+            bp = False
+            end = min(len(text), pos + self.maxlen + 1) if text[pos] == "<" else pos + 2
+            for e in range(end, pos, -1):
+                wd = text[pos:e]
+                if wd in self.bpe_idx:
+                    result.append(self.bpe_idx[wd])
+                    pos = e
+                    bp = True
+                    break
+            if not bp:
+                end = pos + 1
+                wd = text[pos:end]
+                for i in wd.encode("utf-8"):
+                    result.append(self.bpe_idx["<|byte%d|>" % i])
+                pos = end
+        return result
+
+    def decode(self, tokens, breakline="\n"):
+        words = []
+        byte_tokens = []
+        for i in tokens:
+            word = self.bpe[i]
+            if word[:6] == "<|byte" and word[-2:] == "|>":
+                byte_tokens.append(int(word[6:-2]))
+            else:
+                if len(byte_tokens) > 0:
+                    words.append(
+                        bytearray(byte_tokens).decode("utf-8", errors="replace")
+                    )
+                    byte_tokens = []
+                if word[:7] == "<|emoji" and word[-2:] == "|>":
+                    words.append(self.emoji["emoji_inv"][word])
+                elif word == "<SP>":
+                    words.append(" ")
+                elif word == "<BR>":
+                    words.append(breakline)
+                elif word == "<TAB>":
+                    words.append("\t")
+                else:
+                    words.append(word)
+        if len(byte_tokens) > 0:
+            words.append(bytearray(byte_tokens).decode("utf-8", errors="replace"))
+        text = "".join(words)
+        return text
+
+
+def load_texts(src_dir):
+    """Whole files, as encode_bpe.py reads them, and their documents."""
+    texts = []
+    for curDir, dirs, files in os.walk(src_dir):
+        for file in sorted(files):
+            if file.endswith(".txt"):
+                path = os.path.join(curDir, file)
+                with open(path, "r", encoding="utf-8") as fp:
+                    text = fp.read()
+                texts.append((path, text + "<|endoftext|>"))
+                texts.extend(
+                    ("%s#%d" % (path, i), d)
+                    for i, d in enumerate(text.split("<|endoftext|>"))
+                )
+    return texts
+
+
+def first_difference(a, b):
+    for i, (x, y) in enumerate(zip(a, b)):
+        if x != y:
+            return i
+    return min(len(a), len(b))
+
+
+def main():
+    args = parser.parse_args()
+
+    with open("gpt2-japanese/ja-bpe.txt", encoding="utf-8") as f:
+        bpe = f.read().split("\n")
+    with open("gpt2-japanese/emoji.json", encoding="utf-8") as f:
+        emoji = json.loads(f.read())
+    ref = ReferenceEncoder(bpe, emoji)
+    enc = load_encoder()
+
+    texts = load_texts(args.src_dir)
+    if not texts:
+        raise ValueError("no .txt files found in %s" % args.src_dir)
+
+    failures = 0
+
+    def check(what, name, expected, actual):
+        nonlocal failures
+        if expected != actual:
+            failures += 1
+            i = first_difference(expected, actual)
+            print(
+                "MISMATCH %s %s at %d: %r != %r"
+                % (what, name, i, expected[i : i + 8], actual[i : i + 8])
+            )
+
+    for clean in (False, True):
+        what = "encode(clean)" if clean else "encode"
+        expected = [ref.encode(text, clean=clean) for _, text in texts]
+        for (name, text), tokens in zip(texts, expected):
+            check(what, name, tokens, enc.encode(text, clean=clean))
+            check("decode", name, ref.decode(tokens), enc.decode(tokens))
+            check(
+                "decode(<br>)",
+                name,
+                ref.decode(tokens, breakline="<br>"),
+                enc.decode(tokens, breakline="<br>"),
+            )
+
+        batch, offsets = enc.encode_batch([text for _, text in texts], clean=clean)
+        for (name, _), tokens, start, end in zip(
+            texts, expected, offsets[:-1], offsets[1:]
+        ):
+            check(what + "_batch", name, tokens, batch[start:end].tolist())
+        for (name, _), tokens, text in zip(
+            texts, expected, enc.decode_batch(batch, offsets)
+        ):
+            check("decode_batch", name, ref.decode(tokens), text)
+
+    # Arbitrary ids, including byte runs that are not valid UTF-8
+    rng = np.random.RandomState(args.seed)
+    byte_ids = [i for i, w in enumerate(bpe) if w.startswith("<|byte")]
+    for i in range(args.num_random):
+        tokens = rng.randint(0, len(bpe), rng.randint(1, 64)).tolist()
+        for k in np.flatnonzero(rng.rand(len(tokens)) < 0.5):
+            tokens[k] = byte_ids[rng.randint(len(byte_ids))]
+        check("decode", "random#%d" % i, ref.decode(tokens), enc.decode(tokens))
+
+    print(
+        "Checked %d texts and %d random sequences: %d mismatches"
+        % (len(texts), args.num_random, failures)
+    )
+    sys.exit(1 if failures else 0)
+
+
+if __name__ == "__main__":
+    main()
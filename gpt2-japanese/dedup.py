@@ -0,0 +1,72 @@
+import numpy as np
+
+_MASK32 = np.uint64(0xFFFFFFFF)
+
+
+def _permutations(num_perm, seed):
+    rng = np.random.RandomState(seed)
+    a = rng.randint(1, 2**62, size=num_perm, dtype=np.int64).astype(np.uint64)
+    b = rng.randint(0, 2**62, size=num_perm, dtype=np.int64).astype(np.uint64)
+    return a | np.uint64(1), b
+
+
+def minhash(text, *, ngram=5, num_perm=64, seed=1):
+    """MinHash signature of the character n-grams of `text`.
+
+    N-grams are hashed with a polynomial rolling hash over code points, and
+    each permutation is a multiply-shift hash, so the signature only depends
+    on the text and `seed`, not on the process. Returns None for texts with
+    no n-gram.
+    """
+    codes = np.frombuffer(text.encode("utf-32-le"), dtype=np.uint32)
+    if len(codes) < ngram:
+        if len(codes) == 0:
+            return None
+        ngram = len(codes)
+    codes = codes.astype(np.uint64)
+    shingles = np.zeros(len(codes) - ngram + 1, dtype=np.uint64)
+    with np.errstate(over="ignore"):
+        for k in range(ngram):
+            shingles = shingles * np.uint64(1000003) + codes[k : len(shingles) + k]
+        shingles = np.unique(shingles)
+        a, b = _permutations(num_perm, seed)
+        hashed = (a[:, None] * shingles[None, :] + b[:, None]) >> np.uint64(32)
+    return (hashed & _MASK32).min(axis=1).astype(np.uint32)
+
+
+def lsh_bands(threshold, num_perm):
+    """Pick (bands, rows) with bands * rows == num_perm whose S-curve
+    threshold (1 / bands) ** (1 / rows) is closest to `threshold`."""
+    candidates = [
+        (b, num_perm // b) for b in range(1, num_perm + 1) if num_perm % b == 0
+    ]
+    return min(candidates, key=lambda br: abs((1 / br[0]) ** (1 / br[1]) - threshold))
+
+
+def find_duplicates(signatures, threshold):
+    """Return the indices of near-duplicates in a list of MinHash signatures.
+
+    Documents are visited in order and compared, through LSH band buckets,
+    only with earlier documents that were kept; one whose estimated Jaccard
+    similarity to such a document is at least `threshold` is a duplicate.
+    None signatures are never duplicates.
+    """
+    num_perm = next((len(s) for s in signatures if s is not None), 0)
+    if num_perm == 0:
+        return set()
+    bands, rows = lsh_bands(threshold, num_perm)
+    buckets = [{} for _ in range(bands)]
+    duplicates = set()
+    for i, sig in enumerate(signatures):
+        if sig is None:
+            continue
+        keys = [sig[band * rows : (band + 1) * rows].tobytes() for band in range(bands)]
+        candidates = set()
+        for bucket, key in zip(buckets, keys):
+            candidates.update(bucket.get(key, ()))
+        if any(np.mean(signatures[j] == sig) >= threshold for j in candidates):
+            duplicates.add(i)
+            continue
+        for bucket, key in zip(buckets, keys):
+            bucket.setdefault(key, []).append(i)
+    return duplicates
@@ -1,179 +1,847 @@
 import os
 import re
+import sys
+import time
+import queue
 import json
+import mmap
+import marshal
+import hashlib
 import argparse
-import pickle
-from multiprocessing import Pool
+from functools import partial
+from multiprocessing import Pool, Process, Queue
 
 from tqdm import tqdm
 import jaconv
 import numpy as np
 
+from dedup import minhash, find_duplicates
+
+
+class TextNormalizer:
+    """Text normalization applied by BPEEncoder_ja before tokenizing.
+
+    `normalize` maps spaces, line breaks, tabs and dashes in a single
+    str.translate pass. `clean` converts full-width ASCII and digits with
+    jaconv and replaces URLs, e-mail addresses, phone numbers, dates and
+    prices with placeholder tokens.
+
+    The clean rules overlap (a date pattern can match inside a phone number),
+    so they still run one after another instead of as a single alternation.
+    Each rule is paired with the characters any of its matches must contain
+    and is skipped when the text has none of them. Placeholders contain none
+    of these characters, so skipping never changes the output.
+    """
+
+    CHAR_MAP = {
+        " ": "<SP>",
+        "　": "<SP>",
+        "\n": "<BR>",
+        "\r": "<BR>",
+        "\t": "<TAB>",
+        "—": "ー",
+        "−": "ー",
+    }
+
+    def __init__(self):
+        self.table = str.maketrans(self.CHAR_MAP)
+        self.rules = [
+            (
+                re.compile(
+                    r"(https?|ftp)(:\/\/[-_\.!~*\'()a-zA-Z0-9;\/?:\@&=\+$,%#]+)"
+                ),
+                "<URL>",
+                frozenset(":"),
+            ),
+            (
+                re.compile(r"[A-Za-z0-9\._+]*@[\-_0-9A-Za-z]+(\.[A-Za-z]+)*"),
+                "<EMAIL>",
+                frozenset("@"),
+            ),
+            (
+                re.compile(
+                    r"[\(]{0,1}[0-9]{2,4}[\)\-\(]{0,1}[0-9]{2,4}[\)\-]{0,1}[0-9]{3,4}"
+                ),
+                "<TEL>",
+                frozenset("0123456789"),
+            ),
+            (
+                re.compile(
+                    r"([12]\d{3}[/\-年])*(0?[1-9]|1[0-2])[/\-月]((0?[1-9]|[12][0-9]|3[01])日?)*(\d{1,2}|:|\d{1,2}時|\d{1,2}分|\(日\)|\(月\)|\(火\)|\(水\)|\(木\)|\(金\)|\(土\))*"
+                ),
+                "<DATE>",
+                frozenset("/-月"),
+            ),
+            (
+                re.compile(
+                    r"(明治|大正|昭和|平成|令和)\d{1,2}年(0?[1-9]|1[0-2])月(0?[1-9]|[12][0-9]|3[01])日(\d{1,2}|:|\d{1,2}時|\d{1,2}分|\(日\)|\(月\)|\(火\)|\(水\)|\(木\)|\(金\)|\(土\))*"
+                ),
+                "<DATE>",
+                frozenset("年"),
+            ),
+            (
+                re.compile(
+                    r"((0|[1-9]\d*|[1-9]\d{0,2}(,\d{3})+)*億)*((0|[1-9]\d*|[1-9]\d{0,2}(,\d{3})+)*万)*((0|[1-9]\d*|[1-9]\d{0,2}(,\d{3})+)*千)*(0|[1-9]\d*|[1-9]\d{0,2}(,\d{3})+)*(千円|万円|千万円|円|千ドル|万ドル|千万ドル|ドル|千ユーロ|万ユーロ|千万ユーロ|ユーロ)+(\(税込\)|\(税抜\)|\+tax)*"
+                ),
+                "<PRICE>",
+                frozenset("円ドユ"),
+            ),
+        ]
+
+    def normalize(self, text):
+        if "\r\n" in text:
+            text = text.replace("\r\n", "\n")
+        return text.translate(self.table)
+
+    def clean(self, content):
+        content = jaconv.z2h(content, kana=False, digit=True, ascii=True)
+        chars = set(content)
+        for pattern, repl, required in self.rules:
+            if not required.isdisjoint(chars):
+                content = pattern.sub(repl, content)
+        return content
+
 
 class BPEEncoder_ja:
-    def __init__(self, bpe, emoji):
+    # Text that decode emits for whitespace tokens; <BR> follows `breakline`
+    SURFACES = {"<SP>": " ", "<BR>": "\n", "<TAB>": "\t"}
+
+    def __init__(self, bpe, emoji, tables=None):
         self.bpe = bpe
-        self.bpe_idx = {k: v for v, k in enumerate(bpe)}
         self.emoji = emoji
-        self.maxlen = np.max([len(w) for w in self.bpe])
-        self.content_repatter1 = re.compile(
-            r"(https?|ftp)(:\/\/[-_\.!~*\'()a-zA-Z0-9;\/?:\@&=\+$,%#]+)"
-        )
-        self.content_repatter2 = re.compile(
-            r"[A-Za-z0-9\._+]*@[\-_0-9A-Za-z]+(\.[A-Za-z]+)*"
-        )
-        self.content_repatter3 = re.compile(
-            r"[\(]{0,1}[0-9]{2,4}[\)\-\(]{0,1}[0-9]{2,4}[\)\-]{0,1}[0-9]{3,4}"
-        )
-        self.content_repatter4 = re.compile(
-            r"([12]\d{3}[/\-年])*(0?[1-9]|1[0-2])[/\-月]((0?[1-9]|[12][0-9]|3[01])日?)*(\d{1,2}|:|\d{1,2}時|\d{1,2}分|\(日\)|\(月\)|\(火\)|\(水\)|\(木\)|\(金\)|\(土\))*"
-        )
-        self.content_repatter5 = re.compile(
-            r"(明治|大正|昭和|平成|令和)\d{1,2}年(0?[1-9]|1[0-2])月(0?[1-9]|[12][0-9]|3[01])日(\d{1,2}|:|\d{1,2}時|\d{1,2}分|\(日\)|\(月\)|\(火\)|\(水\)|\(木\)|\(金\)|\(土\))*"
-        )
-        self.content_repatter6 = re.compile(
-            r"((0|[1-9]\d*|[1-9]\d{0,2}(,\d{3})+)*億)*((0|[1-9]\d*|[1-9]\d{0,2}(,\d{3})+)*万)*((0|[1-9]\d*|[1-9]\d{0,2}(,\d{3})+)*千)*(0|[1-9]\d*|[1-9]\d{0,2}(,\d{3})+)*(千円|万円|千万円|円|千ドル|万ドル|千万ドル|ドル|千ユーロ|万ユーロ|千万ユーロ|ユーロ)+(\(税込\)|\(税抜\)|\+tax)*"
-        )
+        if tables is None:
+            tables = self.compile_tables(bpe, emoji)
+        self.tables = tables
+        self.prefixes = tables["prefixes"]
+        self.special_re = re.compile(tables["special_pattern"])
+        self.maxlen = tables["maxlen"]
+        self.byte_idx = tables["byte_idx"]
+        self.emoji_items = list(emoji["emoji"].items())
+        self.emoji_prefixes = tables["emoji_prefixes"]
+        self.is_byte = np.frombuffer(tables["is_byte"], dtype=np.bool_)
+        self.byte_value = np.frombuffer(tables["byte_value"], dtype=np.uint8)
+        self.is_byte_list = self.is_byte.tolist()
+        self.byte_value_list = self.byte_value.tolist()
+        self.surfaces = {}
+        self.normalizer = TextNormalizer()
+        # Identifies the sources and table format; set by load_encoder
+        self.version = None
 
     def __len__(self):
         return len(self.bpe)
 
+    @staticmethod
+    def _build_prefixes(words):
+        """Build a flat trie: every word maps to its index, and every proper
+        prefix of a word that is not itself a word maps to -1.
+
+        Walking it one character at a time with text[pos:e] stops at the
+        first slice that is not a key, so no candidate is probed twice.
+        """
+        prefixes = {}
+        for word in words:
+            for j in range(1, len(word)):
+                prefixes.setdefault(word[:j], -1)
+        for i, word in enumerate(words):
+            if word:
+                prefixes[word] = i
+        return prefixes
+
+    @staticmethod
+    def _trie_pattern(words):
+        """Build a regex matching the longest of `words` at a position.
+
+        The alternation is nested like a trie and every word end makes the
+        rest optional, so the greedy match is always the longest word.
+        """
+        root = {}
+        for word in words:
+            node = root
+            for ch in word:
+                node = node.setdefault(ch, {})
+            node[""] = {}
+
+        def pattern(node):
+            alts = [re.escape(ch) + pattern(child) for ch, child in node.items() if ch]
+            if not alts:
+                return ""
+            alts = "(?:%s)" % "|".join(alts)
+            return alts + "?" if "" in node else alts
+
+        return pattern(root)
+
+    @classmethod
+    def compile_tables(cls, bpe, emoji):
+        """Precompute the lookup tables used by encode and decode."""
+        prefixes = cls._build_prefixes(bpe)
+        is_byte = bytearray(len(bpe))
+        byte_value = bytearray(len(bpe))
+        surface = []
+        for i, word in enumerate(bpe):
+            if word[:6] == "<|byte" and word[-2:] == "|>":
+                is_byte[i] = 1
+                byte_value[i] = int(word[6:-2])
+            if word[:7] == "<|emoji" and word[-2:] == "|>":
+                word = emoji["emoji_inv"].get(word, word)
+            surface.append(cls.SURFACES.get(word, word))
+        return {
+            "prefixes": prefixes,
+            "special_pattern": cls._trie_pattern([w for w in bpe if w.startswith("<")]),
+            "maxlen": max(len(w) for w in bpe),
+            "byte_idx": [prefixes.get("<|byte%d|>" % i) for i in range(256)],
+            "emoji_prefixes": cls._build_prefixes(list(emoji["emoji"])),
+            "is_byte": bytes(is_byte),
+            "byte_value": bytes(byte_value),
+            "surface": surface,
+        }
+
+    def replace_emoji(self, text):
+        """Replace emoji with their <|emojiN|> tokens.
+
+        The result is the same as calling str.replace for every entry of the
+        emoji table in order. Later entries are often sequences containing
+        earlier ones (e.g. ZWJ sequences), so a longest-match substitution
+        would change the output. Instead, the entries occurring in the text
+        are collected in a single trie scan and only those are replaced. No
+        replacement can create a new match, as no entry overlaps "<|emojiN|>".
+        """
+        prefixes = self.emoji_prefixes
+        text_len = len(text)
+        found = set()
+        for ch in set(text):
+            if ch not in prefixes:
+                continue
+            pos = text.find(ch)
+            while pos >= 0:
+                for e in range(pos + 1, text_len + 1):
+                    idx = prefixes.get(text[pos:e])
+                    if idx is None:
+                        break
+                    if idx >= 0:
+                        found.add(idx)
+                pos = text.find(ch, pos + 1)
+        for i in sorted(found):
+            k, v = self.emoji_items[i]
+            text = text.replace(k, v)
+        return text
+
     def clean_text(self, content):
-        content = jaconv.z2h(content, kana=False, digit=True, ascii=True)
-        content = self.content_repatter1.sub("<URL>", content)
-        content = self.content_repatter2.sub("<EMAIL>", content)
-        content = self.content_repatter3.sub("<TEL>", content)
-        content = self.content_repatter4.sub("<DATE>", content)
-        content = self.content_repatter5.sub("<DATE>", content)
-        content = self.content_repatter6.sub("<PRICE>", content)
-        return content
+        return self.normalizer.clean(content)
 
     def encode(self, text, clean=False):
-        text = text.replace(" ", "<SP>")
-        text = text.replace("　", "<SP>")
-        text = text.replace("\r\n", "<BR>")
-        text = text.replace("\n", "<BR>")
-        text = text.replace("\r", "<BR>")
-        text = text.replace("\t", "<TAB>")
-        text = text.replace("—", "ー")
-        text = text.replace("−", "ー")
-        for k, v in self.emoji["emoji"].items():
-            if k in text:
-                text = text.replace(k, v)
+        text = self.normalizer.normalize(text)
+        text = self.replace_emoji(text)
         if clean:
             text = self.clean_text(text)
+        prefixes = self.prefixes
+        special_re = self.special_re
+        byte_idx = self.byte_idx
+        text_len = len(text)
         pos = 0
         result = []
-        while pos < len(text):
-            bp = False
-            end = min(len(text), pos + self.maxlen + 1) if text[pos] == "<" else pos + 2
-            for e in range(end, pos, -1):
-                wd = text[pos:e]
-                if wd in self.bpe_idx:
-                    result.append(self.bpe_idx[wd])
-                    pos = e
-                    bp = True
-                    break
-            if not bp:
-                end = pos + 1
-                wd = text[pos:end]
-                for i in wd.encode("utf-8"):
-                    result.append(self.bpe_idx["<|byte%d|>" % i])
-                pos = end
+        while pos < text_len:
+            ch = text[pos]
+            match = prefixes.get(ch, -1)
+            match_end = pos + 1
+            if ch == "<":
+                # Only "<"-prefixed tokens may be longer than two characters,
+                # and special_re finds the longest of them in one step.
+                m = special_re.match(text, pos)
+                if m is not None:
+                    match = prefixes[m.group()]
+                    match_end = m.end()
+            elif ch in prefixes and pos + 1 < text_len:
+                idx = prefixes.get(text[pos : pos + 2], -1)
+                if idx >= 0:
+                    match = idx
+                    match_end = pos + 2
+            if match >= 0:
+                result.append(match)
+                pos = match_end
+            else:
+                for i in ch.encode("utf-8"):
+                    result.append(byte_idx[i])
+                pos += 1
         return result
 
     def decode(self, tokens, breakline="\n"):
+        """Decode token ids to text with the precomputed per-id tables.
+
+        Consecutive <|byteN|> tokens are joined and decoded as one UTF-8
+        sequence. NumPy arrays are decoded with vectorized lookups; short
+        Python lists, e.g. single tokens, are faster with a plain loop.
+        """
+        surface, surface_array = self._surfaces(breakline)
+        if not isinstance(tokens, np.ndarray):
+            is_byte = self.is_byte_list
+            byte_value = self.byte_value_list
+            words = []
+            byte_tokens = []
+            for i in tokens:
+                if is_byte[i]:
+                    byte_tokens.append(byte_value[i])
+                    continue
+                if byte_tokens:
+                    words.append(bytes(byte_tokens).decode("utf-8", errors="replace"))
+                    byte_tokens = []
+                words.append(surface[i])
+            if byte_tokens:
+                words.append(bytes(byte_tokens).decode("utf-8", errors="replace"))
+            return "".join(words)
+
+        ids = tokens.astype(np.intp, copy=False)
+        is_byte = self.is_byte[ids]
+        if not is_byte.any():
+            return "".join(surface_array[ids].tolist())
+        # Boundaries of the runs of byte and non-byte tokens
+        bounds = np.flatnonzero(np.diff(is_byte.view(np.int8))) + 1
+        bounds = [0] + bounds.tolist() + [len(ids)]
         words = []
-        byte_tokens = []
-        for i in tokens:
-            word = self.bpe[i]
-            if word[:6] == "<|byte" and word[-2:] == "|>":
-                byte_tokens.append(int(word[6:-2]))
+        for start, end in zip(bounds[:-1], bounds[1:]):
+            run = ids[start:end]
+            if is_byte[start]:
+                words.append(
+                    self.byte_value[run].tobytes().decode("utf-8", errors="replace")
+                )
             else:
-                if len(byte_tokens) > 0:
-                    words.append(
-                        bytearray(byte_tokens).decode("utf-8", errors="replace")
-                    )
-                    byte_tokens = []
-                if word[:7] == "<|emoji" and word[-2:] == "|>":
-                    words.append(self.emoji["emoji_inv"][word])
-                elif word == "<SP>":
-                    words.append(" ")
-                elif word == "<BR>":
-                    words.append(breakline)
-                elif word == "<TAB>":
-                    words.append("\t")
-                else:
-                    words.append(word)
-        if len(byte_tokens) > 0:
-            words.append(bytearray(byte_tokens).decode("utf-8", errors="replace"))
-        text = "".join(words)
-        return text
+                words.extend(surface_array[run].tolist())
+        return "".join(words)
+
+    def _surfaces(self, breakline):
+        if breakline not in self.surfaces:
+            surface = list(self.tables["surface"])
+            surface[self.prefixes["<BR>"]] = breakline
+            self.surfaces[breakline] = (surface, np.array(surface, dtype=object))
+        return self.surfaces[breakline]
+
+    def encode_batch(self, texts, clean=False, num_workers=1):
+        """Encode many texts into one flat token buffer.
+
+        Returns `(tokens, offsets)`: a uint16 array holding the tokens of every
+        text back to back, and an int64 array of len(texts) + 1 boundaries, so
+        that text i is `tokens[offsets[i] : offsets[i + 1]]`. With
+        `num_workers > 1` the texts are encoded in a process pool.
+        """
+        texts = list(texts)
+        chunks = [
+            (texts[start:end], clean)
+            for start, end in _chunk_bounds(len(texts), num_workers)
+        ]
+        results = self._map_chunks(_encode_chunk, chunks, num_workers)
+        tokens = np.concatenate(
+            [np.empty(0, dtype=np.uint16)] + [r[0] for r in results]
+        )
+        offsets = np.zeros(len(texts) + 1, dtype=np.int64)
+        if texts:
+            np.cumsum(np.concatenate([r[1] for r in results]), out=offsets[1:])
+        return tokens, offsets
+
+    def decode_batch(self, tokens, offsets, breakline="\n", num_workers=1):
+        """Decode a `(tokens, offsets)` buffer as returned by encode_batch."""
+        offsets = np.asarray(offsets, dtype=np.int64)
+        chunks = [
+            (
+                tokens[offsets[start] : offsets[end]],
+                offsets[start : end + 1] - offsets[start],
+                breakline,
+            )
+            for start, end in _chunk_bounds(len(offsets) - 1, num_workers)
+        ]
+        results = self._map_chunks(_decode_chunk, chunks, num_workers)
+        return [text for result in results for text in result]
+
+    def _map_chunks(self, fn, chunks, num_workers):
+        if num_workers > 1 and len(chunks) > 1:
+            with Pool(num_workers, initializer=_init_worker, initargs=(self,)) as p:
+                return p.starmap(fn, chunks)
+        _init_worker(self)
+        return [fn(*chunk) for chunk in chunks]
+
 
+# Bump when the layout of BPEEncoder_ja.compile_tables changes
+TABLES_VERSION = 2
 
-def _proc(i, args):
-    array_file = []
-    for curDir, dirs, files in os.walk(args.src_dir):
-        array_file.append((curDir, dirs, files))
-    with open("gpt2-japanese/ja-bpe.txt", encoding="utf-8") as f:
-        bpe = f.read().split("\n")
-    with open("gpt2-japanese/emoji.json", encoding="utf-8") as f:
-        emoji = json.loads(f.read())
 
+def load_encoder(
+    bpe_path="gpt2-japanese/ja-bpe.txt",
+    emoji_path="gpt2-japanese/emoji.json",
+    tables_path=None,
+):
+    """Load a BPEEncoder_ja, reusing its precompiled lookup tables if possible.
+
+    The vocabulary, emoji table and compiled tables are cached in one binary
+    file (by default next to `bpe_path`, with a ".tables" extension). It is
+    keyed by a hash of both source files, TABLES_VERSION and the Python
+    version, since marshal's format may change between versions. A missing
+    or stale file is rebuilt and atomically replaced on the first load.
+    The same key is exposed as `enc.version`.
+    """
+    if tables_path is None:
+        tables_path = os.path.splitext(bpe_path)[0] + ".tables"
+    with open(bpe_path, "rb") as f:
+        bpe_src = f.read()
+    with open(emoji_path, "rb") as f:
+        emoji_src = f.read()
+    key = hashlib.sha1(bpe_src + b"\0" + emoji_src).hexdigest()
+    version = "%d-%s" % (TABLES_VERSION, key)
+    header = (
+        "BPEJA %d %d.%d %s\n" % ((TABLES_VERSION,) + sys.version_info[:2] + (key,))
+    ).encode()
+
+    try:
+        with open(tables_path, "rb") as f:
+            with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as m:
+                if m[: len(header)] == header:
+                    with memoryview(m)[len(header) :] as view:
+                        bpe, emoji, tables = marshal.loads(view)
+                    enc = BPEEncoder_ja(bpe, emoji, tables)
+                    enc.version = version
+                    return enc
+    except (OSError, ValueError, EOFError, TypeError):
+        pass
+
+    bpe = bpe_src.decode("utf-8").split("\n")
+    emoji = json.loads(emoji_src.decode("utf-8"))
     enc = BPEEncoder_ja(bpe, emoji)
+    enc.version = version
+    tmp_path = "%s.%d.tmp" % (tables_path, os.getpid())
+    try:
+        with open(tmp_path, "wb") as f:
+            f.write(header)
+            f.write(marshal.dumps((bpe, emoji, enc.tables)))
+        os.replace(tmp_path, tables_path)
+    except OSError:
+        # e.g. a read-only checkout: keep working without the cache
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
+    return enc
+
+
+# Encoder used by _encode_chunk/_decode_chunk, set once per pool worker
+_worker_encoder = None
+
+
+def _init_worker(enc):
+    global _worker_encoder
+    _worker_encoder = enc
+
+
+def _chunk_bounds(n, num_workers):
+    # A few chunks per worker, so that uneven texts still balance out
+    size = max(1, -(-n // (max(1, num_workers) * 4)))
+    return [(start, min(start + size, n)) for start in range(0, n, size)]
+
+
+def _encode_chunk(texts, clean):
+    encoded = [_worker_encoder.encode(text, clean=clean) for text in texts]
+    lengths = np.array([len(t) for t in encoded], dtype=np.int64)
+    tokens = np.fromiter(
+        (t for ts in encoded for t in ts), dtype=np.uint16, count=int(lengths.sum())
+    )
+    return tokens, lengths
+
+
+def _decode_chunk(tokens, offsets, breakline):
+    return [
+        _worker_encoder.decode(tokens[start:end], breakline=breakline)
+        for start, end in zip(offsets[:-1], offsets[1:])
+    ]
+
+
+# Token shards are raw little-endian uint16 arrays
+SHARD_DTYPE = "<u2"
+SHARD_ITEMSIZE = np.dtype(SHARD_DTYPE).itemsize
+
+
+class ShardWriter:
+    """Stream uint16 tokens to a raw shard file, recording document bounds.
+
+    A shard is a flat little-endian uint16 array, so readers can map it with
+    np.memmap. Only the small document index is kept in memory.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self.fp = open(path, "wb")
+        self.n_tokens = 0
+        self.documents = []
 
-    token_chunks = []
-    raw_text = ""
-    for j, (curDir, dirs, files) in enumerate(array_file):
-        if not (j % args.num_process == i):
+    def write(self, tokens, source, source_offset=0):
+        """Append the tokens of `source`, starting at byte `source_offset`.
+
+        The index entry is [source, source_offset, token_offset, n_tokens].
+        """
+        tokens = np.asarray(tokens, dtype=SHARD_DTYPE)
+        tokens.tofile(self.fp)
+        self.documents.append([source, source_offset, self.n_tokens, len(tokens)])
+        self.n_tokens += len(tokens)
+
+    def close(self):
+        self.fp.close()
+        return {
+            "path": self.path,
+            "n_tokens": self.n_tokens,
+            "documents": self.documents,
+        }
+
+
+class TokenCache:
+    """Token shards of encoded source ranges, one file per range, named by a
+    hash of the raw bytes, the tokenizer version and the encode options.
+
+    A re-run only encodes ranges whose content changed; the rest of the
+    dataset is assembled from the cached files without reading them.
+    """
+
+    def __init__(self, cache_dir, version, clean):
+        os.makedirs(cache_dir, exist_ok=True)
+        self.cache_dir = cache_dir
+        self.prefix = "%s\0%d\0" % (version, clean)
+
+    def path(self, data, last):
+        h = hashlib.sha1((self.prefix + "%d\0" % last).encode())
+        h.update(data)
+        return os.path.join(self.cache_dir, h.hexdigest() + ".tokens")
+
+    def put(self, path, tokens):
+        tmp_path = "%s.%d.tmp" % (path, os.getpid())
+        np.asarray(tokens, dtype=SHARD_DTYPE).tofile(tmp_path)
+        os.replace(tmp_path, path)
+
+
+def write_manifest(path, shards):
+    """Write the JSON index listing the shards of an encoded dataset.
+
+    Shard paths are stored relative to the manifest.
+    """
+    root = os.path.dirname(os.path.abspath(path))
+    shards = [
+        dict(shard, path=os.path.relpath(shard["path"], root)) for shard in shards
+    ]
+    with open(path, "w", encoding="utf-8") as fp:
+        json.dump({"dtype": SHARD_DTYPE, "shards": shards}, fp, ensure_ascii=False)
+
+
+def load_token_arrays(path):
+    """Return the token arrays of a dataset, either an .npz archive or a
+    JSON manifest written by encode_bpe.py.
+
+    Shards are memory-mapped, and a manifest yields one view per encoded
+    source range, ordered by source path and offset. Which shard a range
+    was written to depends on worker timing; this order does not.
+    """
+    if path.endswith(".npz"):
+        with np.load(path) as npz:
+            return [npz[item] for item in npz.files]
+    with open(path, encoding="utf-8") as fp:
+        manifest = json.load(fp)
+    root = os.path.dirname(path)
+    ranges = []
+    for shard in manifest["shards"]:
+        if shard["n_tokens"] == 0:
             continue
-        print("append #", curDir)
-        for file in tqdm(files):
-            if file.endswith(".txt"):
-                input = os.path.join(curDir, file)
-                with open(input, "r", encoding="utf-8") as fp:
-                    raw_text += fp.read()
-                raw_text += "<|endoftext|>"
-                if len(raw_text) >= args.combine:
-                    tokens = np.stack(enc.encode(raw_text, clean=args.clean_text))
-                    token_chunks.append(tokens)
-                    raw_text = ""
-        if raw_text and len(raw_text) > 0:
-            tokens = np.stack(enc.encode(raw_text))
-            token_chunks.append(tokens)
-    with open("tmp%d.pkl" % i, "wb") as f:
-        pickle.dump(token_chunks, f)
-
-
-def proc(args):
-    return _proc(*args)
+        tokens = np.memmap(
+            os.path.join(root, shard["path"]),
+            dtype=manifest["dtype"],
+            mode="r",
+            shape=(shard["n_tokens"],),
+        )
+        for source, source_offset, offset, n_tokens in shard["documents"]:
+            if n_tokens > 0:
+                ranges.append(
+                    ((source, source_offset), tokens[offset : offset + n_tokens])
+                )
+    ranges.sort(key=lambda r: r[0])
+    return [tokens for _, tokens in ranges]
+
+
+ENDOFTEXT = b"<|endoftext|>"
+
+
+def _plan_work(src_dir, split_size):
+    """List (path, start, end, last) byte ranges of the .txt files in src_dir,
+    largest first.
+
+    Files larger than split_size are cut right after an <|endoftext|>
+    separator, which is always a token of its own, so the ranges encode to
+    the same tokens as the whole file. `last` marks the final range of a file.
+    """
+    work = []
+    for curDir, dirs, files in os.walk(src_dir):
+        for file in files:
+            if not file.endswith(".txt"):
+                continue
+            path = os.path.join(curDir, file)
+            size = os.path.getsize(path)
+            bounds = [0]
+            with open(path, "rb") as fp:
+                while size - bounds[-1] > split_size:
+                    fp.seek(bounds[-1] + split_size)
+                    buf = fp.read(split_size)
+                    idx = buf.find(ENDOFTEXT)
+                    bound = bounds[-1] + split_size + idx + len(ENDOFTEXT)
+                    # No separator left, or only the one ending the file
+                    if idx < 0 or bound >= size:
+                        break
+                    bounds.append(bound)
+            bounds.append(size)
+            for start, end in zip(bounds[:-1], bounds[1:]):
+                work.append((path, start, end, end == size))
+    work.sort(key=lambda w: w[1] - w[2])
+    return work
+
+
+def _read_range(path, start, end):
+    with open(path, "rb") as fp:
+        fp.seek(start)
+        return fp.read(end - start)
+
+
+def _range_signatures(item, ngram, num_perm):
+    """MinHash signatures of the documents of a byte range, one per piece of
+    the range split at <|endoftext|>; None for blank pieces."""
+    path, start, end, _ = item
+    signatures = []
+    for piece in _read_range(path, start, end).split(ENDOFTEXT):
+        text = piece.decode("utf-8").strip()
+        signatures.append(
+            minhash(text, ngram=ngram, num_perm=num_perm) if text else None
+        )
+    return signatures
+
+
+def _plan_dedup(work, args):
+    """Return {(path, start): indices of the duplicate pieces of that range}.
+
+    Signatures are computed in parallel; the LSH pass visits documents in
+    file order, so the first copy of a document is the one kept.
+    """
+    ordered = sorted(work)
+    with Pool(args.num_process) as pool:
+        per_range = list(
+            tqdm(
+                pool.imap(
+                    partial(
+                        _range_signatures,
+                        ngram=args.dedup_ngram,
+                        num_perm=args.dedup_num_perm,
+                    ),
+                    ordered,
+                ),
+                total=len(ordered),
+                desc="minhash",
+            )
+        )
+    keys = []
+    signatures = []
+    for (path, start, _, _), sigs in zip(ordered, per_range):
+        keys.extend((path, start, j) for j in range(len(sigs)))
+        signatures.extend(sigs)
+    drop = {}
+    for k in find_duplicates(signatures, args.dedup_threshold):
+        path, start, j = keys[k]
+        drop.setdefault((path, start), set()).add(j)
+    n_documents = sum(s is not None for s in signatures)
+    return drop, n_documents
+
+
+def _worker(i, args, tasks, results):
+    enc = load_encoder()
+    if args.cache_dir:
+        cache = TokenCache(args.cache_dir, enc.version, args.clean_text)
+    else:
+        writer = ShardWriter("%s.%d.tokens" % (args.dst_file, i))
+    for path, start, end, last, drop in iter(tasks.get, None):
+        data = _read_range(path, start, end)
+        n_dropped = 0
+        if drop:
+            pieces = data.split(ENDOFTEXT)
+            n_dropped = sum(
+                len(_encode_range(enc, pieces[j], True, args.clean_text)) for j in drop
+            )
+            data = ENDOFTEXT.join(p for j, p in enumerate(pieces) if j not in drop)
+        if args.cache_dir:
+            cache_path = cache.path(data, last)
+            cached = os.path.exists(cache_path)
+            if cached:
+                n_tokens = os.path.getsize(cache_path) // SHARD_ITEMSIZE
+            else:
+                tokens = _encode_range(enc, data, last, args.clean_text)
+                cache.put(cache_path, tokens)
+                n_tokens = len(tokens)
+            shard = {
+                "path": cache_path,
+                "n_tokens": n_tokens,
+                "documents": [[path, start, 0, n_tokens]],
+            }
+            results.put(("progress", end - start, n_tokens, cached, n_dropped))
+            results.put(("shard", None, shard))
+        else:
+            tokens = _encode_range(enc, data, last, args.clean_text)
+            writer.write(tokens, path, start)
+            results.put(("progress", end - start, len(tokens), False, n_dropped))
+    results.put(("done", i, None if args.cache_dir else writer.close()))
+
+
+def _encode_range(enc, data, last, clean):
+    raw_text = data.decode("utf-8")
+    if last:
+        raw_text += "<|endoftext|>"
+    return enc.encode(raw_text, clean=clean)
+
+
+def encode_corpus(args):
+    """Encode the .txt files under args.src_dir into token shards.
+
+    Byte ranges are handed out largest first through a shared queue, so the
+    workers stay busy however the files are laid out in directories.
+    """
+    work = _plan_work(args.src_dir, args.split_size)
+    total_bytes = sum(end - start for _, start, end, _ in work)
+    drop, n_documents = {}, 0
+    if args.dedup_threshold:
+        drop, n_documents = _plan_dedup(work, args)
+    tasks = Queue()
+    results = Queue()
+    for path, start, end, last in work:
+        tasks.put((path, start, end, last, drop.get((path, start))))
+    for _ in range(args.num_process):
+        tasks.put(None)
+    workers = [
+        Process(target=_worker, args=(i, args, tasks, results))
+        for i in range(args.num_process)
+    ]
+    for w in workers:
+        w.start()
+
+    shards = []
+    n_done = 0
+    n_tokens = 0
+    n_cached = 0
+    n_dropped = 0
+    start_time = time.time()
+    with tqdm(total=total_bytes, unit="B", unit_scale=True) as pbar:
+        while n_done < args.num_process:
+            try:
+                msg = results.get(timeout=1)
+            except queue.Empty:
+                if any(w.exitcode not in (None, 0) for w in workers):
+                    raise RuntimeError("an encoding worker exited abnormally")
+                continue
+            if msg[0] == "progress":
+                n_tokens += msg[2]
+                n_cached += msg[3]
+                n_dropped += msg[4]
+                pbar.update(msg[1])
+                pbar.set_postfix(
+                    tokens_per_sec="%.0f" % (n_tokens / (time.time() - start_time))
+                )
+            elif msg[0] == "shard":
+                shards.append(msg[2])
+            else:
+                n_done += 1
+                if msg[2] is not None:
+                    shards.append(msg[2])
+    for w in workers:
+        w.join()
+    # Keep the manifest order stable; load_token_arrays orders the ranges
+    # within the shards
+    shards.sort(key=lambda shard: shard["documents"][:1])
+
+    elapsed = max(time.time() - start_time, 1e-9)
+    print(
+        "Encoded {mb:.1f} MB into {tokens} tokens in {sec:.1f}s "
+        "({mbps:.2f} MB/s, {tps:.0f} tokens/s)".format(
+            mb=total_bytes / 1e6,
+            tokens=n_tokens,
+            sec=elapsed,
+            mbps=total_bytes / 1e6 / elapsed,
+            tps=n_tokens / elapsed,
+        )
+    )
+    if args.dedup_threshold:
+        print(
+            "Removed {docs} of {total} documents ({tokens} tokens) "
+            "as near-duplicates".format(
+                docs=sum(len(d) for d in drop.values()),
+                total=n_documents,
+                tokens=n_dropped,
+            )
+        )
+    if args.cache_dir:
+        print(
+            "Reused {cached} of {total} ranges from {cache_dir}".format(
+                cached=n_cached, total=len(work), cache_dir=args.cache_dir
+            )
+        )
+    return shards
 
 
 if __name__ == "__main__":
 
     parser = argparse.ArgumentParser()
     parser.add_argument("--src_dir", help="source dir", required=True)
-    parser.add_argument("--dst_file", help="destnation file", required=True)
-    parser.add_argument("--num_process", help="process num", type=int, default=8)
+    parser.add_argument(
+        "--dst_file",
+        help="destination prefix; writes <dst_file>.json and its .tokens shards",
+        required=True,
+    )
+    parser.add_argument(
+        "--num_process", help="process num", type=int, default=os.cpu_count()
+    )
+    parser.add_argument(
+        "--split_size",
+        help="Split files larger than this many bytes at <|endoftext|> separators",
+        type=int,
+        default=16 * 1024 * 1024,
+    )
     parser.add_argument(
         "--combine",
-        help="Concatenate files with <|endoftext|> separator into chunks of this minimum size",
+        help="Deprecated and ignored: files are now encoded and written one by one",
         type=int,
         default=50000,
     )
     parser.add_argument("--clean_text", action="store_true")
+    parser.add_argument(
+        "--cache_dir",
+        help="Reuse tokens of unchanged source ranges cached in this directory",
+        default=None,
+    )
+    parser.add_argument(
+        "--dedup_threshold",
+        help="Drop documents whose estimated Jaccard similarity to an earlier "
+        "document is at least this value (e.g. 0.8)",
+        type=float,
+        default=None,
+    )
+    parser.add_argument(
+        "--dedup_ngram",
+        help="Character n-gram size of the dedup MinHash",
+        type=int,
+        default=5,
+    )
+    parser.add_argument(
+        "--dedup_num_perm",
+        help="Number of MinHash permutations",
+        type=int,
+        default=64,
+    )
+    parser.add_argument(
+        "--compress",
+        action="store_true",
+        help="Also pack the shards into <dst_file>.npz and remove them",
+    )
     args = parser.parse_args()
 
-    values = []
-    for i in range(args.num_process):
-        values.append((i, args))
-
-    with Pool(args.num_process) as p:
-        p.map(proc, values)
+    shards = encode_corpus(args)
 
-    token_chunks = []
-    for i in range(args.num_process):
-        with open("tmp%d.pkl" % i, "rb") as f:
-            token_chunks.extend(pickle.load(f))
+    manifest = args.dst_file + ".json"
+    write_manifest(manifest, shards)
 
-    np.savez_compressed(args.dst_file, *token_chunks)
+    if args.compress:
+        # np.savez writes each memory-mapped shard in bounded-size chunks
+        np.savez_compressed(args.dst_file, *load_token_arrays(manifest))
+        if not args.cache_dir:
+            for i in range(args.num_process):
+                os.remove("%s.%d.tokens" % (args.dst_file, i))
+        os.remove(manifest)
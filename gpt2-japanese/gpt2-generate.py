@@ -10,7 +10,8 @@ import tensorflow._api.v2.compat.v1 as tf
 tf.get_logger().setLevel("ERROR")
 
 from sampling import sample_sequence
-from encode_bpe import BPEEncoder_ja
+from encode_bpe import load_encoder
+import model
 from model import HParams as HParams
 
 parser = argparse.ArgumentParser()
@@ -24,15 +25,21 @@ parser.add_argument("--temperature", type=float, default=1)
 parser.add_argument("--gpu", type=str, default="0")
 parser.add_argument("--max_length", type=int, default=500)
 parser.add_argument("--min_length", type=int, default=0)
+parser.add_argument(
+    "--precision",
+    type=str,
+    default="float32",
+    choices=["float32", "bfloat16"],
+    help="dtype of the matmuls and activations",
+)
+parser.add_argument(
+    "--xla",
+    action="store_true",
+    help="Compile the sampling loop with XLA, once per 64-token bucket of lengths",
+)
 args = parser.parse_args()
 
-with open("gpt2-japanese/ja-bpe.txt", encoding="utf-8") as f:
-    bpe = f.read().split("\n")
-
-with open("gpt2-japanese/emoji.json", encoding="utf-8") as f:
-    emoji = json.loads(f.read())
-
-enc = BPEEncoder_ja(bpe, emoji)
+enc = load_encoder()
 n_vocab = len(enc)
 
 if os.path.isfile(args.model + "/hparams.json"):
@@ -119,11 +126,11 @@ with tf.Session(config=config, graph=tf.Graph()) as sess:
         temperature=temperature,
         top_k=top_k,
         top_p=top_p,
+        dtype=tf.as_dtype(args.precision),
+        xla=args.xla,
     )
 
-    saver = tf.train.Saver()
-    ckpt = tf.train.latest_checkpoint(args.model)
-    saver.restore(sess, ckpt)
+    model.restore(sess, args.model)
 
     if len(args.output_file) > 0:
 
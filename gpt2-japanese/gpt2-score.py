@@ -6,13 +6,14 @@ import argparse
 os.environ["TF_CPP_MIN_LOG_LEVEL"] = "3"
 os.environ["TF_DETERMINISTIC_OPS"] = "0"
 
+import numpy as np
 import tensorflow._api.v2.compat.v1 as tf
 
 tf.get_logger().setLevel("ERROR")
 
 from model import HParams as HParams
 import model
-from encode_bpe import BPEEncoder_ja
+from encode_bpe import load_encoder
 
 
 def score_tokens(*, hparams, tokens):
@@ -56,13 +57,7 @@ parser.add_argument("--exclude-end", action="store_true")
 parser.add_argument("--gpu", type=str, default="0")
 args = parser.parse_args()
 
-with open("gpt2-japanese/ja-bpe.txt", encoding="utf-8") as f:
-    bpe = f.read().split("\n")
-
-with open("gpt2-japanese/emoji.json", encoding="utf-8") as f:
-    emoji = json.loads(f.read())
-
-enc = BPEEncoder_ja(bpe, emoji)
+enc = load_encoder()
 n_vocab = len(enc)
 
 if os.path.isfile(args.model + "/hparams.json"):
@@ -127,19 +122,23 @@ with tf.Session(config=config, graph=tf.Graph()) as sess:
 
     output = score_tokens(hparams=hparams, tokens=tokens_tensor)
 
-    saver = tf.train.Saver()
-    ckpt = tf.train.latest_checkpoint(args.model)
-    saver.restore(sess, ckpt)
+    model.restore(sess, args.model)
 
     end_token = enc.encode("<|endoftext|>")[0]
     start_token = end_token  # it does double duty
 
-    for text in texts:
+    batch_tokens, batch_offsets = enc.encode_batch(texts)
+
+    for i, text in enumerate(texts):
         # prepend the start token so that we get a probability for the first "real" token
-        tokens = enc.encode(text)
-        if not args.exclude_end:
-            tokens += [end_token]
-        tokens_with_start = [start_token] + tokens
+        row = batch_tokens[batch_offsets[i] : batch_offsets[i + 1]]
+        tokens_with_start = np.empty(len(row) + 2, dtype=np.int32)
+        tokens_with_start[0] = start_token
+        tokens_with_start[1:-1] = row
+        tokens_with_start[-1] = end_token
+        if args.exclude_end:
+            tokens_with_start = tokens_with_start[:-1]
+        tokens = tokens_with_start[1:]
 
         logprobs = sess.run(
             output,
@@ -153,6 +152,6 @@ with tf.Session(config=config, graph=tf.Graph()) as sess:
 
         print("%s\t%.5g" % (text, sum(logprobs_list)))
         if args.tokens:
-            for t, lp in zip(tokens, logprobs_list):
+            for t, lp in zip(tokens.tolist(), logprobs_list):
                 print("%s\t%.5g" % (enc.decode([t]), lp))
             print()
@@ -7,7 +7,7 @@ import numpy as np
 import tensorflow._api.v2.compat.v1 as tf
 
 import model
-from encode_bpe import BPEEncoder_ja
+from encode_bpe import load_encoder
 from model import HParams as HParams
 
 parser = argparse.ArgumentParser()
@@ -16,13 +16,7 @@ parser.add_argument("--context", type=str, required=True)
 parser.add_argument("--gpu", type=str, default="0")
 args = parser.parse_args()
 
-with open("ja-bpe.txt", encoding="utf-8") as f:
-    bpe = f.read().split("\n")
-
-with open("emoji.json", encoding="utf-8") as f:
-    emoji = json.loads(f.read())
-
-enc = BPEEncoder_ja(bpe, emoji)
+enc = load_encoder("ja-bpe.txt", "emoji.json")
 n_vocab = len(enc)
 
 if os.path.isfile(args.model + "/hparams.json"):
@@ -70,9 +64,7 @@ with tf.Session(config=config, graph=tf.Graph()) as sess:
     context = tf.placeholder(tf.int32, [1, None])
     output = model.model(hparams=hparams, X=context, past=None, reuse=tf.AUTO_REUSE)
 
-    saver = tf.train.Saver()
-    ckpt = tf.train.latest_checkpoint(args.model)
-    saver.restore(sess, ckpt)
+    model.restore(sess, args.model)
 
     context_tokens = enc.encode(args.context)
     out = sess.run(output, feed_dict={context: [context_tokens]})
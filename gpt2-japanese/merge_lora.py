@@ -0,0 +1,54 @@
+import os
+import json
+import argparse
+
+os.environ["TF_CPP_MIN_LOG_LEVEL"] = "2"
+
+import tensorflow._api.v2.compat.v1 as tf
+
+import model
+from model import HParams as HParams
+
+tf.get_logger().setLevel("ERROR")
+
+parser = argparse.ArgumentParser(
+    description="Merge the LoRA adapters of a run_finetune.py run into its base "
+    "model and write the result as a full model directory.",
+)
+parser.add_argument("--model", type=str, required=True, help="LoRA run directory")
+parser.add_argument("--output", type=str, required=True, help="output directory")
+
+
+def main():
+    args = parser.parse_args()
+
+    with open(os.path.join(args.model, "hparams.json"), encoding="utf-8") as f:
+        hparams = HParams(**json.loads(f.read()))
+
+    with tf.Session(graph=tf.Graph()) as sess:
+        context = tf.placeholder(tf.int32, [1, None])
+        model.model(hparams=hparams, X=context)
+        model.restore(sess, args.model)
+
+        os.makedirs(args.output, exist_ok=True)
+        saver = tf.train.Saver()
+        saver.save(sess, os.path.join(args.output, "model"))
+        with open(
+            os.path.join(args.output, "hparams.json"), "w", encoding="utf-8"
+        ) as f:
+            f.write(
+                json.dumps(
+                    {
+                        "n_vocab": hparams.n_vocab,
+                        "n_ctx": hparams.n_ctx,
+                        "n_embd": hparams.n_embd,
+                        "n_head": hparams.n_head,
+                        "n_layer": hparams.n_layer,
+                    }
+                )
+            )
+    print("Wrote", args.output)
+
+
+if __name__ == "__main__":
+    main()
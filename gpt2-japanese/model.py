@@ -1,14 +1,30 @@
+import os
+import json
+import contextlib
+
 import numpy as np
 import tensorflow._api.v2.compat.v1 as tf
 
 
 class HParams:
-    def __init__(self, n_vocab=0, n_ctx=1024, n_embd=768, n_head=12, n_layer=12):
+    def __init__(
+        self,
+        n_vocab=0,
+        n_ctx=1024,
+        n_embd=768,
+        n_head=12,
+        n_layer=12,
+        lora_rank=0,
+        lora_alpha=16.0,
+    ):
         self.n_vocab = n_vocab
         self.n_ctx = n_ctx
         self.n_embd = n_embd
         self.n_head = n_head
         self.n_layer = n_layer
+        # Rank of the LoRA adapters of the projections, 0 for none
+        self.lora_rank = lora_rank
+        self.lora_alpha = lora_alpha
 
 
 def shape_list(x):
@@ -29,7 +45,11 @@ def gelu(x):
 
 
 def norm(x, scope, *, axis=-1, epsilon=1e-5):
-    """Normalize to mean = 0, std = 1, then do a diagonal affine transform."""
+    """Normalize to mean = 0, std = 1, then do a diagonal affine transform.
+
+    The statistics are computed in float32 whatever the dtype of x."""
+    dtype = x.dtype
+    x = tf.cast(x, tf.float32)
     with tf.variable_scope(scope):
         if int(tf.__version__[0]) > 1:
             n_state = x.shape[-1]
@@ -41,7 +61,7 @@ def norm(x, scope, *, axis=-1, epsilon=1e-5):
         s = tf.reduce_mean(tf.square(x - u), axis=axis, keepdims=True)
         x = (x - u) * tf.rsqrt(s + epsilon)
         x = x * g + b
-        return x
+        return tf.cast(x, dtype)
 
 
 def split_states(x, n):
@@ -56,7 +76,10 @@ def merge_states(x):
     return tf.reshape(x, start + [a * b])
 
 
-def conv1d(x, scope, nf, *, w_init_stdev=0.02):
+def conv1d(x, scope, nf, *, w_init_stdev=0.02, lora_rank=0, lora_alpha=16.0):
+    """With lora_rank > 0, a low-rank update (x @ lora_a) @ lora_b scaled by
+    lora_alpha / lora_rank is added. lora_b starts at zero, so the output
+    starts equal to the base projection."""
     with tf.variable_scope(scope):
         *start, nx = shape_list(x)
         w = tf.get_variable(
@@ -65,10 +88,23 @@ def conv1d(x, scope, nf, *, w_init_stdev=0.02):
             initializer=tf.random_normal_initializer(stddev=w_init_stdev),
         )
         b = tf.get_variable("b", [nf], initializer=tf.constant_initializer(0))
-        c = tf.reshape(
-            tf.matmul(tf.reshape(x, [-1, nx]), tf.reshape(w, [-1, nf])) + b,
-            start + [nf],
-        )
+        w = tf.cast(w, x.dtype)
+        b = tf.cast(b, x.dtype)
+        x_flat = tf.reshape(x, [-1, nx])
+        c = tf.matmul(x_flat, tf.reshape(w, [-1, nf])) + b
+        if lora_rank > 0:
+            lora_a = tf.get_variable(
+                "lora_a",
+                [nx, lora_rank],
+                initializer=tf.random_normal_initializer(stddev=w_init_stdev),
+            )
+            lora_b = tf.get_variable(
+                "lora_b", [lora_rank, nf], initializer=tf.constant_initializer(0)
+            )
+            c += tf.matmul(
+                tf.matmul(x_flat, tf.cast(lora_a, x.dtype)), tf.cast(lora_b, x.dtype)
+            ) * tf.cast(lora_alpha / lora_rank, x.dtype)
+        c = tf.reshape(c, start + [nf])
         return c
 
 
@@ -83,7 +119,7 @@ def attention_mask(nd, ns, *, dtype):
     return tf.cast(m, dtype)
 
 
-def attn(x, scope, n_state, *, past, hparams):
+def attn(x, scope, n_state, *, past, hparams, segments=None, past_length=None):
     assert x.shape.ndims == 3  # Should be [batch, sequence, features]
     assert n_state % hparams.n_head == 0
     if past is not None:
@@ -104,6 +140,15 @@ def attn(x, scope, n_state, *, past, hparams):
         _, _, nd, ns = shape_list(w)
         b = attention_mask(nd, ns, dtype=w.dtype)
         b = tf.reshape(b, [1, 1, nd, ns])
+        if past_length is not None:
+            # Only the first past_length entries of the cache are filled
+            j = tf.range(ns)
+            filled = tf.logical_or(j < past_length, j >= ns - nd)
+            b = b * tf.cast(filled, w.dtype)
+        if segments is not None:
+            # Only attend within the same document
+            same = tf.equal(segments[:, :, None], segments[:, None, :])
+            b = b * tf.cast(same[:, None], w.dtype)
         w = w * b - tf.cast(1e10, w.dtype) * (1 - b)
         return w
 
@@ -115,13 +160,15 @@ def attn(x, scope, n_state, *, past, hparams):
         else:
             w = w * tf.rsqrt(tf.cast(v.shape[-1].value, w.dtype))
 
-        w = mask_attn_weights(w)
+        # Mask and softmax in float32
+        w = mask_attn_weights(tf.cast(w, tf.float32))
         w = softmax(w)
-        a = tf.matmul(w, v)
+        a = tf.matmul(tf.cast(w, v.dtype), v)
         return a
 
     with tf.variable_scope(scope):
-        c = conv1d(x, "c_attn", n_state * 3)
+        lora = dict(lora_rank=hparams.lora_rank, lora_alpha=hparams.lora_alpha)
+        c = conv1d(x, "c_attn", n_state * 3, **lora)
         q, k, v = map(split_heads, tf.split(c, 3, axis=2))
         present = tf.stack([k, v], axis=1)
         if past is not None:
@@ -130,7 +177,7 @@ def attn(x, scope, n_state, *, past, hparams):
             v = tf.concat([pv, v], axis=-2)
         a = multihead_attn(q, k, v)
         a = merge_heads(a)
-        a = conv1d(a, "c_proj", n_state)
+        a = conv1d(a, "c_proj", n_state, **lora)
         return a, present
 
 
@@ -140,18 +187,27 @@ def mlp(x, scope, n_state, *, hparams):
             nx = x.shape[-1]
         else:
             nx = x.shape[-1].value
-        h = gelu(conv1d(x, "c_fc", n_state))
-        h2 = conv1d(h, "c_proj", nx)
+        lora = dict(lora_rank=hparams.lora_rank, lora_alpha=hparams.lora_alpha)
+        h = gelu(conv1d(x, "c_fc", n_state, **lora))
+        h2 = conv1d(h, "c_proj", nx, **lora)
         return h2
 
 
-def block(x, scope, *, past, hparams):
+def block(x, scope, *, past, hparams, segments=None, past_length=None):
     with tf.variable_scope(scope):
         if int(tf.__version__[0]) > 1:
             nx = x.shape[-1]
         else:
             nx = x.shape[-1].value
-        a, present = attn(norm(x, "ln_1"), "attn", nx, past=past, hparams=hparams)
+        a, present = attn(
+            norm(x, "ln_1"),
+            "attn",
+            nx,
+            past=past,
+            hparams=hparams,
+            segments=segments,
+            past_length=past_length,
+        )
         x = x + a
         m = mlp(norm(x, "ln_2"), "mlp", nx * 4, hparams=hparams)
         x = x + m
@@ -182,7 +238,68 @@ def positions_for(tokens, past_length):
     return expand_tile(past_length + tf.range(nsteps), batch_size)
 
 
-def model(hparams, X, past=None, scope="model", reuse=tf.AUTO_REUSE):
+def positions_in_segments(segments):
+    """Positions counted from the start of each segment.
+
+    `segments` is [batch, sequence] of non-decreasing ids along each row, so
+    a segment starts after the tokens whose id is smaller than its own.
+    """
+    before = tf.less(segments[:, None, :], segments[:, :, None])
+    starts = tf.reduce_sum(tf.cast(before, tf.int32), axis=-1)
+    return tf.range(tf.shape(segments)[1])[None, :] - starts
+
+
+def checkpoint_segments(policy, n_layer):
+    """Split the blocks into segments recomputed during the backward pass.
+
+    `policy` is "none", "every:K" (keep the output of every K-th block),
+    "sqrt" (every ceil(sqrt(n_layer)) blocks) or "layers:I,J,..." (keep the
+    outputs of the listed blocks). Returns None for "none".
+    """
+    if policy == "none":
+        return None
+    if policy == "sqrt":
+        policy = "every:%d" % int(np.ceil(np.sqrt(n_layer)))
+    kind, _, value = policy.partition(":")
+    if kind == "every" and value.isdigit() and int(value) > 0:
+        kept = range(int(value) - 1, n_layer, int(value))
+    elif kind == "layers" and value:
+        kept = [int(layer) for layer in value.split(",")]
+        if not all(0 <= layer < n_layer for layer in kept):
+            raise ValueError("checkpoint layers must be in [0, %d)" % n_layer)
+    else:
+        raise ValueError("invalid checkpoint policy: %s" % policy)
+    bounds = sorted(set([0, n_layer] + [layer + 1 for layer in kept]))
+    return [list(range(a, b)) for a, b in zip(bounds[:-1], bounds[1:])]
+
+
+def model(
+    hparams,
+    X,
+    past=None,
+    scope="model",
+    reuse=tf.AUTO_REUSE,
+    checkpoints=None,
+    dtype=tf.float32,
+    segments=None,
+    past_length=None,
+):
+    """`checkpoints` is a list of block segments from checkpoint_segments().
+    Only the input of each segment is kept for the backward pass, and no
+    "present" is returned. It needs `past` to be None.
+
+    `dtype` is the dtype of the matmuls and activations, e.g. tf.bfloat16.
+    Variables stay float32; LayerNorm, softmax and the logits are float32,
+    and `past`/"present" are in `dtype`.
+
+    `segments` ([batch, sequence] int32, non-decreasing along each row)
+    packs several documents in a row: tokens only attend to tokens of the
+    same segment, and positions restart at each segment. It needs `past`
+    to be None.
+
+    With `past_length` (int32 scalar), `past` is a fixed-size cache of which
+    only the first past_length positions are attended to, so the graph keeps
+    one shape while the cache fills up (see sampling.py)."""
     with tf.variable_scope(scope, reuse=reuse):
         results = {}
         batch, sequence = shape_list(X)
@@ -197,27 +314,102 @@ def model(hparams, X, past=None, scope="model", reuse=tf.AUTO_REUSE):
             [hparams.n_vocab, hparams.n_embd],
             initializer=tf.random_normal_initializer(stddev=0.02),
         )
-        past_length = 0 if past is None else tf.shape(past)[-2]
-        h = tf.gather(wte, X) + tf.gather(wpe, positions_for(X, past_length))
+        if segments is not None:
+            assert past is None
+            positions = positions_in_segments(segments)
+        elif past_length is not None:
+            positions = positions_for(X, past_length)
+        else:
+            positions = positions_for(X, 0 if past is None else tf.shape(past)[-2])
+        h = tf.gather(wte, X) + tf.gather(wpe, positions)
+        h = tf.cast(h, dtype)
 
         # Transformer
+        if checkpoints is not None:
+            assert past is None
+            for segment in checkpoints:
+                h = tf.recompute_grad(_blocks(segment, hparams, segments))(h)
+            return _lm_head(results, h, wte, batch, sequence, hparams)
+
         presents = []
         pasts = (
             tf.unstack(past, axis=1) if past is not None else [None] * hparams.n_layer
         )
         assert len(pasts) == hparams.n_layer
         for layer, past in enumerate(pasts):
-            h, present = block(h, "h%d" % layer, past=past, hparams=hparams)
+            h, present = block(
+                h,
+                "h%d" % layer,
+                past=past,
+                hparams=hparams,
+                segments=segments,
+                past_length=past_length,
+            )
             if layer == 10:
                 tf.add_to_collection("checkpoints", h)
             presents.append(present)
         results["present"] = tf.stack(presents, axis=1)
-        h = norm(h, "ln_f")
-
-        # Language model loss.  Do tokens <n predict token n?
-        h_flat = tf.reshape(h, [batch * sequence, hparams.n_embd])
-        results["h_flat"] = h_flat
-        logits = tf.matmul(h_flat, wte, transpose_b=True)
-        logits = tf.reshape(logits, [batch, sequence, hparams.n_vocab])
-        results["logits"] = logits
-        return results
+        return _lm_head(results, h, wte, batch, sequence, hparams)
+
+
+def _blocks(layers, hparams, segments):
+    def f(h):
+        for layer in layers:
+            h, _ = block(
+                h, "h%d" % layer, past=None, hparams=hparams, segments=segments
+            )
+        return h
+
+    return f
+
+
+def _lm_head(results, h, wte, batch, sequence, hparams):
+    h = norm(h, "ln_f")
+
+    # Language model loss.  Do tokens <n predict token n?
+    h_flat = tf.reshape(h, [batch * sequence, hparams.n_embd])
+    results["h_flat"] = tf.cast(h_flat, tf.float32)
+    logits = tf.matmul(h_flat, tf.cast(wte, h_flat.dtype), transpose_b=True)
+    logits = tf.reshape(tf.cast(logits, tf.float32), [batch, sequence, hparams.n_vocab])
+    results["logits"] = logits
+    return results
+
+
+def jit_scope(enabled):
+    """Compile the ops created in this scope, and their gradients, with XLA."""
+    if enabled:
+        return tf.xla.experimental.jit_scope()
+    return contextlib.nullcontext()
+
+
+def is_lora_variable(var):
+    return "/lora_" in var.name
+
+
+def restore(sess, model_dir):
+    """Restore the latest checkpoint of `model_dir` into the current graph.
+
+    A LoRA run directory (with an adapter.json written by run_finetune.py)
+    holds only the adapters: the base model named there is restored, then
+    each adapter is merged into its projection, so a graph built without
+    adapters runs the fine-tuned model at no extra cost.
+    """
+    adapter_path = os.path.join(model_dir, "adapter.json")
+    if not os.path.isfile(adapter_path):
+        saver = tf.train.Saver()
+        saver.restore(sess, tf.train.latest_checkpoint(model_dir))
+        return
+
+    with open(adapter_path, encoding="utf-8") as fp:
+        adapter = json.load(fp)
+    restore(sess, adapter["base_model"])
+    reader = tf.train.load_checkpoint(tf.train.latest_checkpoint(model_dir))
+    weights = {v.op.name: v for v in tf.global_variables()}
+    scale = adapter["lora_alpha"] / adapter["lora_rank"]
+    for name in reader.get_variable_to_shape_map():
+        if not name.endswith("/lora_a"):
+            continue
+        scope = name[: -len("/lora_a")]
+        delta = reader.get_tensor(name) @ reader.get_tensor(scope + "/lora_b")
+        w = weights[scope + "/w"]
+        sess.run(w.initializer, {w.initial_value: sess.run(w) + scale * delta[None]})
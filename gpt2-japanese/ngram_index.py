@@ -0,0 +1,106 @@
+import os
+import sys
+import argparse
+
+import numpy as np
+
+from encode_bpe import load_encoder, load_token_arrays
+
+_MULT = np.uint64(0x9E3779B97F4A7C15)
+
+
+def ngram_hashes(tokens, n):
+    """64-bit hashes of every window of n consecutive tokens."""
+    tokens = np.asarray(tokens, dtype=np.uint64)
+    count = len(tokens) - n + 1
+    if count <= 0:
+        return np.zeros(0, dtype=np.uint64)
+    hashes = np.zeros(count, dtype=np.uint64)
+    with np.errstate(over="ignore"):
+        for k in range(n):
+            hashes = (hashes + tokens[k : count + k] + np.uint64(1)) * _MULT
+    return hashes
+
+
+class NgramIndex:
+    """Sorted set of the token n-gram hashes of a training set.
+
+    Answers how long a run of a candidate's tokens also appears in the
+    training data, with one binary search per n-gram.
+    """
+
+    def __init__(self, hashes, n):
+        self.hashes = hashes
+        self.n = n
+
+    @classmethod
+    def build(cls, token_arrays, n=8):
+        hashes = [np.zeros(0, dtype=np.uint64)]
+        hashes.extend(ngram_hashes(t, n) for t in token_arrays)
+        return cls(np.unique(np.concatenate(hashes)), n)
+
+    @classmethod
+    def load(cls, path):
+        with np.load(path) as npz:
+            return cls(npz["hashes"], int(npz["n"]))
+
+    def save(self, path):
+        os.makedirs(os.path.dirname(path) or ".", exist_ok=True)
+        np.savez(path, hashes=self.hashes, n=self.n)
+
+    def contains(self, hashes):
+        # No document of the training set was n tokens long
+        if len(self.hashes) == 0:
+            return np.zeros(len(hashes), dtype=bool)
+        idx = np.searchsorted(self.hashes, hashes)
+        idx[idx == len(self.hashes)] = 0
+        return self.hashes[idx] == hashes
+
+    def longest_overlap(self, tokens):
+        """Return (tokens in the longest run found in the training data,
+        fraction of the candidate's tokens covered by such runs)."""
+        found = self.contains(ngram_hashes(tokens, self.n))
+        if not found.any():
+            return 0, 0.0
+        # Lengths of the runs of consecutive matching n-grams
+        edges = np.diff(np.concatenate(([0], found.astype(np.int8), [0])))
+        starts = np.flatnonzero(edges == 1)
+        ends = np.flatnonzero(edges == -1)
+        covered = np.zeros(len(tokens), dtype=bool)
+        for start, end in zip(starts, ends):
+            covered[start : end + self.n - 1] = True
+        return int((ends - starts).max()) + self.n - 1, float(covered.mean())
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(
+        description="Find generated texts copied from the training data."
+    )
+    subparsers = parser.add_subparsers(dest="command", required=True)
+    build = subparsers.add_parser("build", help="Index an encoded dataset")
+    build.add_argument(
+        "--dataset", help="manifests (.json) or .npz", nargs="+", required=True
+    )
+    build.add_argument("--output", help="index file (.npz)", required=True)
+    build.add_argument("--n", help="n-gram length in tokens", type=int, default=8)
+    check = subparsers.add_parser(
+        "check",
+        help="Print the longest overlap in tokens and the covered fraction",
+    )
+    check.add_argument("input_file")
+    check.add_argument("--index", required=True)
+    args = parser.parse_args()
+
+    if args.command == "build":
+        arrays = [a for path in args.dataset for a in load_token_arrays(path)]
+        index = NgramIndex.build(arrays, args.n)
+        index.save(args.output)
+        print("Indexed %d %d-grams" % (len(index.hashes), index.n))
+        sys.exit(0)
+
+    enc = load_encoder()
+    index = NgramIndex.load(args.index)
+    with open(args.input_file, encoding="utf-8") as f:
+        tokens = enc.encode(f.read().strip())
+    overlap, coverage = index.longest_overlap(tokens)
+    print("%d\t%.3f" % (overlap, coverage))
@@ -1,8 +1,13 @@
 import os
 import time
 import json
+import queue
+import shutil
+import resource
 import argparse
-from copy import copy
+import tempfile
+import threading
+import multiprocessing
 
 os.environ["TF_DETERMINISTIC_OPS"] = "0"
 os.environ["TF_CPP_MIN_LOG_LEVEL"] = "2"
@@ -11,7 +16,10 @@ import tqdm
 import numpy as np
 import tensorflow._api.v2.compat.v1 as tf
 
-from encode_bpe import BPEEncoder_ja
+from google.protobuf import text_format
+from tensorflow.python.client import timeline
+
+from encode_bpe import load_encoder, load_token_arrays
 import model
 from model import HParams as HParams
 
@@ -26,7 +34,11 @@ parser = argparse.ArgumentParser(
 )
 
 parser.add_argument(
-    "--dataset", metavar="PATH", type=str, required=True, help="Input npz file"
+    "--dataset",
+    metavar="PATH",
+    type=str,
+    required=True,
+    help="Input dataset: a .json manifest from encode_bpe.py or an npz file",
 )
 parser.add_argument(
     "--base_model", type=str, default="gpt2ja-small", help="a path to a model file"
@@ -35,6 +47,59 @@ parser.add_argument(
 parser.add_argument(
     "--batch_size", metavar="SIZE", type=int, default=1, help="Batch size"
 )
+parser.add_argument(
+    "--accumulate_steps",
+    metavar="N",
+    type=int,
+    default=1,
+    help="Apply gradients summed over N batches of --batch_size (effective batch "
+    "size is batch_size * N)",
+)
+parser.add_argument(
+    "--checkpoint_policy",
+    type=str,
+    default="none",
+    help="Recompute block activations in the backward pass, keeping only the "
+    'outputs of some blocks: "none", "every:K", "sqrt" or "layers:I,J,..."',
+)
+parser.add_argument(
+    "--precision",
+    type=str,
+    default="float32",
+    choices=["float32", "bfloat16"],
+    help="dtype of the matmuls and activations; weights and the loss stay float32",
+)
+parser.add_argument(
+    "--xla",
+    action="store_true",
+    help="Compile the model, the loss and their gradients with XLA (the "
+    "training and evaluation batches have fixed shapes, so they are compiled "
+    "once each)",
+)
+parser.add_argument(
+    "--pack_length",
+    metavar="L",
+    type=int,
+    default=0,
+    help="Pack whole documents into rows of L tokens, attending and counting "
+    "positions within each document and masking padding out of the loss "
+    "(0: train on n_ctx windows of the token stream)",
+)
+parser.add_argument(
+    "--lora_rank",
+    metavar="R",
+    type=int,
+    default=0,
+    help="Train only rank-R adapters of the attention and MLP projections, "
+    "keeping the base weights frozen; checkpoints hold only the adapters "
+    "(0: train all weights)",
+)
+parser.add_argument(
+    "--lora_alpha",
+    type=float,
+    default=16.0,
+    help="The adapters' update is scaled by lora_alpha / lora_rank",
+)
 parser.add_argument(
     "--optim",
     type=str,
@@ -55,6 +120,21 @@ parser.add_argument(
     default=0,
     help="Learning rate warming up steps",
 )
+parser.add_argument(
+    "--lr_schedule",
+    type=str,
+    default="constant",
+    choices=["constant", "linear", "cosine", "inverse_sqrt"],
+    help="Learning rate after the warmup: constant, decayed linearly or along a "
+    "cosine to 0 at --decay_steps, or proportional to 1/sqrt(step)",
+)
+parser.add_argument(
+    "--decay_steps",
+    metavar="N",
+    type=int,
+    default=0,
+    help="Step at which linear and cosine schedules reach 0 (0: --num_iter)",
+)
 
 parser.add_argument(
     "--run_name",
@@ -69,14 +149,98 @@ parser.add_argument(
     default=1000,
     help="Write a checkpoint every N steps",
 )
+parser.add_argument(
+    "--save_optimizer",
+    action="store_true",
+    help="Also save the optimizer state and step, for --resume (adam triples "
+    "the checkpoint size)",
+)
+parser.add_argument(
+    "--resume",
+    action="store_true",
+    help="Continue from the latest checkpoint of --run_name, with its optimizer "
+    "state if it was saved; --base_model still gives the hparams (and the "
+    "frozen weights of a LoRA run)",
+)
+parser.add_argument(
+    "--replay_dataset",
+    metavar="PATH",
+    type=str,
+    default="",
+    help="Older data to mix into the training rows of --dataset, e.g. the "
+    "documents of earlier runs when resuming",
+)
+parser.add_argument(
+    "--replay_fraction",
+    metavar="F",
+    type=float,
+    default=0.25,
+    help="Fraction of the training rows sampled from --replay_dataset",
+)
 
 parser.add_argument("--gpu", default="0", help="visible gpu number.")
+parser.add_argument(
+    "--num_workers",
+    metavar="N",
+    type=int,
+    default=1,
+    help="Train with N local data-parallel worker processes, each on its own "
+    "shard of the dataset and with 1/N of the CPU threads",
+)
 parser.add_argument(
     "--num_iter",
     type=int,
     default=400,
     help="The number of iteration steps",
 )
+parser.add_argument(
+    "--prefetch",
+    metavar="N",
+    type=int,
+    default=2,
+    help="Batches prepared ahead by a background thread (0 to disable)",
+)
+parser.add_argument(
+    "--report_input_wait",
+    action="store_true",
+    help="Log how long each step waits for its batch",
+)
+parser.add_argument(
+    "--val_fraction",
+    type=float,
+    default=0.0,
+    help="Hold out this fraction of the chunks for evaluation",
+)
+parser.add_argument(
+    "--eval_every",
+    metavar="N",
+    type=int,
+    default=0,
+    help="Compute the held-out loss and perplexity every N steps",
+)
+parser.add_argument(
+    "--eval_batch_size",
+    metavar="SIZE",
+    type=int,
+    default=8,
+    help="Batch size of the held-out evaluation",
+)
+parser.add_argument(
+    "--early_stop_patience",
+    metavar="P",
+    type=int,
+    default=0,
+    help="Stop when the held-out loss has not improved in P evaluations "
+    "(0: never stop early)",
+)
+parser.add_argument(
+    "--trace_steps",
+    metavar="A:B",
+    type=str,
+    default=None,
+    help="Write a Chrome trace (trace-<step>.json in the run directory) and "
+    "TensorBoard run metadata for steps A to B-1",
+)
 
 
 def maketree(path):
@@ -86,19 +250,313 @@ def maketree(path):
         pass
 
 
-with open("gpt2-japanese/ja-bpe.txt", encoding="utf-8") as f:
-    bpe = f.read().split("\n")
+enc = load_encoder()
+n_vocab = len(enc)
 
-with open("gpt2-japanese/emoji.json", encoding="utf-8") as f:
-    emoji = json.loads(f.read())
 
-enc = BPEEncoder_ja(bpe, emoji)
-n_vocab = len(enc)
+def load_chunks(path, n_ctx, pad):
+    """Return the tokens of a dataset as an [n_chunks, n_ctx] uint16 matrix.
 
+    A final partial chunk of more than one token is padded with `pad`. A
+    dataset of a single encoded range that needs no padding is used
+    memory-mapped, without a copy.
+    """
+    arrays = load_token_arrays(path)
+    n_tokens = sum(len(a) for a in arrays)
+    n_chunks = n_tokens // n_ctx
+    if n_tokens % n_ctx > 1:
+        n_chunks += 1
+    elif len(arrays) == 1:
+        return arrays[0][: n_chunks * n_ctx].reshape(n_chunks, n_ctx)
+    tokens = np.full(max(n_chunks * n_ctx, n_tokens), pad, dtype=np.uint16)
+    if arrays:
+        np.concatenate(arrays, out=tokens[:n_tokens])
+    return tokens[: n_chunks * n_ctx].reshape(n_chunks, n_ctx)
 
-def main():
-    args = parser.parse_args()
 
+def load_packed(path, length, eot, pad):
+    """Pack the documents of a dataset into rows of `length` tokens.
+
+    Documents end after an `eot` token. They are placed whole and in order
+    while they fit in the current row, the rest of which is padded with
+    `pad`; documents longer than a row are split. Returns the
+    [n_rows, length] uint16 matrix, the number of tokens in each row and the
+    number of documents.
+    """
+    arrays = load_token_arrays(path)
+    tokens = np.concatenate([np.zeros(0, dtype=np.uint16)] + arrays)
+    ends = np.flatnonzero(tokens == eot) + 1
+    bounds = np.unique(np.concatenate(([0], ends, [len(tokens)])))
+    n_pieces = -(-np.diff(bounds) // length)
+    first = np.repeat(np.cumsum(n_pieces) - n_pieces, n_pieces)
+    starts = np.repeat(bounds[:-1], n_pieces) + (np.arange(len(first)) - first) * length
+    sizes = np.minimum(length, np.repeat(bounds[1:], n_pieces) - starts)
+
+    rows = np.zeros(len(sizes), dtype=np.int64)
+    offsets = np.zeros(len(sizes), dtype=np.int64)
+    row = fill = 0
+    for i, size in enumerate(sizes.tolist()):
+        if fill + size > length:
+            row += 1
+            fill = 0
+        rows[i] = row
+        offsets[i] = fill
+        fill += size
+    n_rows = row + 1 if len(sizes) else 0
+
+    packed = np.full(n_rows * length, pad, dtype=np.uint16)
+    dest = np.repeat(rows * length + offsets - starts, sizes) + np.arange(len(tokens))
+    packed[dest] = tokens
+    lengths = np.bincount(rows, weights=sizes, minlength=n_rows).astype(np.int64)
+    return packed.reshape(n_rows, length), lengths, len(bounds) - 1
+
+
+def learning_rate_schedule(
+    schedule, learning_rate, global_step, warmup_steps, decay_steps
+):
+    """Learning rate tensor for the optimizer step `global_step`: a linear
+    warmup over `warmup_steps`, then `schedule`."""
+    step = tf.cast(global_step, tf.float32)
+    warmup_steps = float(warmup_steps)
+    if schedule == "constant":
+        decay = tf.constant(1.0)
+    elif schedule in ("linear", "cosine"):
+        progress = tf.clip_by_value(
+            (step - warmup_steps) / max(decay_steps - warmup_steps, 1.0), 0.0, 1.0
+        )
+        if schedule == "linear":
+            decay = 1.0 - progress
+        else:
+            decay = 0.5 * (1.0 + tf.cos(np.pi * progress))
+    elif schedule == "inverse_sqrt":
+        floor = max(warmup_steps, 1.0)
+        decay = tf.sqrt(floor / tf.maximum(step, floor))
+    else:
+        raise ValueError("invalid learning rate schedule.")
+    if warmup_steps > 0:
+        decay *= tf.minimum((step + 1.0) / warmup_steps, 1.0)
+    return learning_rate * decay
+
+
+class Prefetcher:
+    """Call `fn` in a background thread, keeping up to `size` results ahead.
+
+    A single producer keeps the results in the order `fn` returns them.
+    """
+
+    def __init__(self, fn, size):
+        self.fn = fn
+        self.queue = queue.Queue(maxsize=size)
+        self.stopped = threading.Event()
+        self.thread = threading.Thread(target=self._run, daemon=True)
+        self.thread.start()
+
+    def _run(self):
+        while not self.stopped.is_set():
+            try:
+                item = self.fn()
+            except Exception as e:
+                item = e
+            while not self.stopped.is_set():
+                try:
+                    self.queue.put(item, timeout=0.1)
+                    break
+                except queue.Full:
+                    pass
+            if isinstance(item, Exception):
+                return
+
+    def get(self):
+        item = self.queue.get()
+        if isinstance(item, Exception):
+            raise item
+        return item
+
+    def close(self):
+        self.stopped.set()
+        self.thread.join()
+
+
+def _fsync(path):
+    fd = os.open(path, os.O_RDONLY)
+    try:
+        os.fsync(fd)
+    finally:
+        os.close(fd)
+
+
+def atomic_write(path, text):
+    """Replace `path` by `text` through a fsynced temporary file, so a crash
+    leaves either the old or the new contents."""
+    tmp_path = path + ".tmp"
+    with open(tmp_path, "w", encoding="utf-8") as fp:
+        fp.write(text)
+        fp.flush()
+        os.fsync(fp.fileno())
+    os.replace(tmp_path, path)
+    _fsync(os.path.dirname(path) or ".")
+
+
+class AsyncCheckpointer:
+    """Write checkpoints of `var_list` to `save_dir` in a background thread.
+
+    save() copies the variables into snapshot variables in host memory and
+    returns while the snapshot is written; at most one save is in flight.
+    The checkpoint data is fsynced before the checkpoint index and then the
+    other files are atomically replaced, so they always name a complete
+    checkpoint. Keeps checkpoints like tf.train.Saver's max_to_keep and
+    keep_checkpoint_every_n_hours.
+    """
+
+    def __init__(
+        self, sess, var_list, save_dir, max_to_keep=5, keep_checkpoint_every_n_hours=2
+    ):
+        self.sess = sess
+        self.save_dir = save_dir
+        self.max_to_keep = max_to_keep
+        self.keep_seconds = keep_checkpoint_every_n_hours * 3600
+        self.next_keep_time = time.time() + self.keep_seconds
+        # Take over the checkpoints of an earlier run in save_dir, so that they
+        # are rotated out too
+        state = tf.train.get_checkpoint_state(save_dir)
+        self.kept = [
+            (path, os.path.getmtime(path + ".index"))
+            for path in (state.all_model_checkpoint_paths if state else [])
+            if os.path.exists(path + ".index")
+        ]
+        with tf.device("/cpu:0"), tf.name_scope("snapshot"):
+            # Left out of the variable collections: only save() writes them
+            snapshots = [
+                tf.Variable(
+                    tf.zeros(v.shape, v.dtype.base_dtype),
+                    trainable=False,
+                    collections=[],
+                    name=v.op.name,
+                )
+                for v in var_list
+            ]
+        self.snapshot = tf.group([s.assign(v) for s, v in zip(snapshots, var_list)])
+        self.saver = tf.train.Saver(
+            var_list={v.op.name: s for v, s in zip(var_list, snapshots)}
+        )
+        self.thread = None
+        self.error = None
+        # (step, seconds) of the last finished write, until read by the caller
+        self.written = None
+
+    def save(self, step, files):
+        """Write model-`step`, then replace each path of the {path: text}
+        `files`. Blocks only for the previous save and the snapshot."""
+        self.wait()
+        self.sess.run(self.snapshot)
+        self.thread = threading.Thread(target=self._write, args=(step, files))
+        self.thread.start()
+
+    def _write(self, step, files):
+        start = time.time()
+        try:
+            # The default graph is per thread
+            with self.sess.graph.as_default():
+                prefix = self.saver.save(
+                    self.sess,
+                    os.path.join(self.save_dir, "model"),
+                    global_step=step,
+                    write_state=False,
+                )
+            for path in (prefix + ".index", prefix + ".meta"):
+                _fsync(path)
+            for name in os.listdir(self.save_dir):
+                if name.startswith(os.path.basename(prefix) + ".data-"):
+                    _fsync(os.path.join(self.save_dir, name))
+
+            self.kept = [k for k in self.kept if k[0] != prefix]
+            self.kept.append((prefix, time.time()))
+            removed = []
+            if len(self.kept) > self.max_to_keep:
+                (old, saved_time) = self.kept.pop(0)
+                if saved_time > self.next_keep_time:
+                    self.next_keep_time += self.keep_seconds
+                else:
+                    removed.append(old)
+            state = tf.train.generate_checkpoint_state_proto(
+                self.save_dir, prefix, [k[0] for k in self.kept]
+            )
+            atomic_write(
+                os.path.join(self.save_dir, "checkpoint"),
+                text_format.MessageToString(state),
+            )
+            for path, text in files.items():
+                atomic_write(path, text)
+            for old in removed:
+                tf.train.remove_checkpoint(old)
+            self.written = (step, time.time() - start)
+        except Exception as e:
+            self.error = e
+
+    def wait(self):
+        """Wait for the save in flight and raise its error, if any."""
+        self.close()
+        if self.error is not None:
+            error = self.error
+            self.error = None
+            raise error
+
+    def close(self):
+        if self.thread is not None:
+            self.thread.join()
+            self.thread = None
+
+
+class SharedAllReduce:
+    """Average float32 vectors across the local worker processes.
+
+    Each worker writes its vector to its own row of a file mapped in shared
+    memory, then averages one slice of all the rows after a barrier, so the
+    reduction is spread over the workers. A second barrier publishes the
+    result.
+    """
+
+    def __init__(self, path, rank, world, barrier):
+        self.path = path
+        self.rank = rank
+        self.world = world
+        self.barrier = barrier
+
+    def setup(self, size):
+        shape = (self.world + 1, size)
+        if self.rank == 0:
+            np.memmap(self.path, dtype=np.float32, mode="w+", shape=shape).flush()
+        self.barrier.wait()
+        buf = np.memmap(self.path, dtype=np.float32, mode="r+", shape=shape)
+        self.rows, self.result = buf[:-1], buf[-1]
+        bounds = np.linspace(0, size, self.world + 1).astype(np.int64)
+        self.lo, self.hi = bounds[self.rank], bounds[self.rank + 1]
+
+    def mean(self, x):
+        """Return the mean of `x` over the workers; `x` may be shorter than
+        the size given to setup()."""
+        n = len(x)
+        lo, hi = min(self.lo, n), min(self.hi, n)
+        self.rows[self.rank, :n] = x
+        self.barrier.wait()
+        np.mean(self.rows[:, lo:hi], axis=0, out=self.result[lo:hi])
+        self.barrier.wait()
+        return np.array(self.result[:n])
+
+    def broadcast(self, x):
+        """Return rank 0's `x` on every worker."""
+        n = len(x)
+        if self.rank == 0:
+            self.result[:n] = x
+        self.barrier.wait()
+        x = np.array(self.result[:n])
+        self.barrier.wait()
+        return x
+
+
+def train(args, rank=0, reducer=None):
+    """Fine-tune as worker `rank`. With a `reducer`, gradients are averaged
+    across the workers and only rank 0 logs and writes checkpoints."""
     if os.path.isfile(args.base_model + "/hparams.json"):
         with open(args.base_model + "/hparams.json", encoding="utf-8") as f:
             params = json.loads(f.read())
@@ -135,36 +593,83 @@ def main():
         )
     else:
         raise ValueError("invalid model name.")
+    hparams.lora_rank = args.lora_rank
+    hparams.lora_alpha = args.lora_alpha
 
     config = tf.ConfigProto()
     if int(args.gpu) >= 0:
         config.gpu_options.allow_growth = True
         config.gpu_options.visible_device_list = args.gpu
+    if reducer is not None:
+        config.intra_op_parallelism_threads = max(1, os.cpu_count() // reducer.world)
+    if args.pack_length > hparams.n_ctx:
+        raise ValueError("pack_length must not exceed n_ctx (%d)" % hparams.n_ctx)
+
+    if not 0 <= args.replay_fraction < 1:
+        raise ValueError("replay_fraction must be in [0, 1)")
+
+    counter = 1
+    counter_path = os.path.join(CHECKPOINT_DIR, args.run_name, "counter")
+    if os.path.exists(counter_path):
+        # Load the step number if we're resuming a run
+        # Add 1 so we don't immediately try to save again
+        with open(counter_path, "r", encoding="utf-8") as fp:
+            counter = int(fp.read()) + 1
+
     with tf.Session(config=config, graph=tf.Graph()) as sess:
         context = tf.placeholder(tf.int32, [None, None])
-        output = model.model(hparams=hparams, X=context, past=None, reuse=tf.AUTO_REUSE)
-        loss = tf.reduce_mean(
-            tf.nn.sparse_softmax_cross_entropy_with_logits(
+        if args.pack_length > 0:
+            segments = tf.placeholder(tf.int32, [None, None])
+            loss_mask = tf.placeholder(tf.float32, [None, None])
+        else:
+            segments = None
+        with model.jit_scope(args.xla):
+            output = model.model(
+                hparams=hparams,
+                X=context,
+                past=None,
+                reuse=tf.AUTO_REUSE,
+                checkpoints=model.checkpoint_segments(
+                    args.checkpoint_policy, hparams.n_layer
+                ),
+                dtype=tf.as_dtype(args.precision),
+                segments=segments,
+            )
+            token_loss = tf.nn.sparse_softmax_cross_entropy_with_logits(
                 labels=context[:, 1:], logits=output["logits"][:, :-1]
             )
+        if args.pack_length > 0:
+            # Mean over the targets that are not padding
+            loss_weights = loss_mask[:, 1:]
+            loss = tf.reduce_sum(token_loss * loss_weights) / tf.maximum(
+                tf.reduce_sum(loss_weights), 1.0
+            )
+        else:
+            loss_weights = tf.ones_like(token_loss)
+            loss = tf.reduce_mean(token_loss)
+        # Summed over the batch, for the held-out evaluation
+        eval_loss = (
+            tf.reduce_sum(token_loss * loss_weights),
+            tf.reduce_sum(loss_weights),
         )
 
-        saver = tf.train.Saver()
+        base_saver = tf.train.Saver(
+            var_list=[v for v in tf.global_variables() if not model.is_lora_variable(v)]
+        )
         ckpt = tf.train.latest_checkpoint(args.base_model)
-        saver.restore(sess, ckpt)
-
-        train_vars = tf.trainable_variables()
+        base_saver.restore(sess, ckpt)
 
-        global_step = tf.Variable(0, trainable=False)
-        if args.warmup_steps > 0:
-            learning_rate = tf.compat.v1.train.polynomial_decay(
-                learning_rate=1e-10,
-                end_learning_rate=args.learning_rate,
-                global_step=global_step,
-                decay_steps=args.warmup_steps,
-            )
-        else:
-            learning_rate = args.learning_rate
+        # Incremented by opt_apply, so the schedule follows the applied updates
+        global_step = tf.Variable(
+            counter - 1, trainable=False, dtype=tf.int64, name="global_step"
+        )
+        learning_rate = learning_rate_schedule(
+            args.lr_schedule,
+            args.learning_rate,
+            global_step,
+            args.warmup_steps,
+            args.decay_steps or counter - 1 + args.num_iter,
+        )
 
         if args.optim == "adam":
             opt = tf.train.AdamOptimizer(
@@ -178,128 +683,596 @@ def main():
             raise ValueError("invalid optimizer name.")
 
         train_vars = tf.trainable_variables()
+        if args.lora_rank > 0:
+            train_vars = [v for v in train_vars if model.is_lora_variable(v)]
         opt_grads = tf.gradients(loss, train_vars)
+        if args.accumulate_steps > 1:
+            # Sum the gradients of micro-batches in variables, apply their mean
+            accum_vars = [
+                tf.Variable(
+                    tf.zeros(v.shape, dtype=v.dtype.base_dtype), trainable=False
+                )
+                for v in train_vars
+            ]
+            opt_reset = [a.assign(tf.zeros_like(a)) for a in accum_vars]
+            opt_compute = [
+                a.assign_add(tf.convert_to_tensor(g))
+                for a, g in zip(accum_vars, opt_grads)
+            ]
+            opt_grads = [a / args.accumulate_steps for a in accum_vars]
+        if reducer is not None:
+            # Gradients are fetched flat, averaged across workers and fed back
+            grads_flat = tf.concat(
+                [tf.reshape(tf.convert_to_tensor(g), [-1]) for g in opt_grads], 0
+            )
+            grads_in = tf.placeholder(tf.float32, grads_flat.shape)
+            opt_grads = [
+                tf.reshape(g, v.shape)
+                for g, v in zip(
+                    tf.split(grads_in, [v.shape.num_elements() for v in train_vars]),
+                    train_vars,
+                )
+            ]
+            # The mean loss and token count travel with the gradients
+            reducer.setup(grads_flat.shape.num_elements() + 2)
         opt_grads = list(zip(opt_grads, train_vars))
-        opt_apply = opt.apply_gradients(opt_grads)
+        opt_apply = opt.apply_gradients(opt_grads, global_step=global_step)
 
         summaries = tf.summary.scalar("loss", loss)
         summary_log = tf.summary.FileWriter(os.path.join(CHECKPOINT_DIR, args.run_name))
 
-        saver = tf.train.Saver(
-            var_list=train_vars, max_to_keep=5, keep_checkpoint_every_n_hours=2
-        )
+        saved_vars = list(train_vars)
+        if args.save_optimizer:
+            saved_vars += opt.variables() + [global_step]
+        checkpointer = None
+        if rank == 0:
+            checkpointer = AsyncCheckpointer(
+                sess,
+                saved_vars,
+                os.path.join(CHECKPOINT_DIR, args.run_name),
+                max_to_keep=5,
+                keep_checkpoint_every_n_hours=2,
+            )
         sess.run(tf.global_variables_initializer())
 
         ckpt = tf.train.latest_checkpoint(args.base_model)
-        saver.restore(sess, ckpt)
+        base_saver.restore(sess, ckpt)
         print("Loading checkpoint", ckpt)
 
+        if args.resume:
+            ckpt = tf.train.latest_checkpoint(
+                os.path.join(CHECKPOINT_DIR, args.run_name)
+            )
+            if ckpt is None:
+                print("No checkpoint of", args.run_name, "to resume, starting anew")
+            else:
+                # Whatever of the trained weights and optimizer state was saved
+                saved = tf.train.load_checkpoint(ckpt).get_variable_to_shape_map()
+                resume_vars = [
+                    v
+                    for v in train_vars + opt.variables() + [global_step]
+                    if v.op.name in saved
+                ]
+                tf.train.Saver(var_list=resume_vars).restore(sess, ckpt)
+                has_state = global_step.op.name in saved
+                print(
+                    "Resuming from {} {} optimizer state".format(
+                        ckpt, "with" if has_state else "without"
+                    )
+                )
+
+        if reducer is not None and args.lora_rank > 0:
+            # Each worker draws its own random adapters; start all of them
+            # from rank 0's, since they apply the same averaged gradients
+            for v in train_vars:
+                value = sess.run(v)
+                value = reducer.broadcast(value.ravel()).reshape(value.shape)
+                sess.run(v.initializer, {v.initial_value: value})
+
         print("Loading dataset...")
-        global_chunks = []
-        with np.load(args.dataset) as npz:
-            current_token = []
-            for inditem, item in enumerate(npz.files):
-                token_chunk = npz[item]
-                for ind in range(0, len(token_chunk)):
-                    current_token.append(np.uint16(token_chunk[ind]))
-                    if len(current_token) == hparams.n_ctx:
-                        global_chunks.append(current_token)
-                        current_token = []
-            if len(current_token) > 1:
-                global_chunks.append(
-                    current_token + [n_vocab - 1] * (hparams.n_ctx - len(current_token))
+        eot = enc.encode("<|endoftext|>")[0]
+        if args.pack_length > 0:
+            global_chunks, global_lengths, n_docs = load_packed(
+                args.dataset, args.pack_length, eot, n_vocab - 1
+            )
+            print(
+                "Packed {docs} documents into {rows} rows ({pct:.1f}% padding)".format(
+                    docs=n_docs,
+                    rows=len(global_chunks),
+                    pct=100 - 100 * global_lengths.sum() / max(global_chunks.size, 1),
+                )
+            )
+        else:
+            global_chunks = load_chunks(args.dataset, hparams.n_ctx, n_vocab - 1)
+            global_lengths = None
+
+        # Chunks are selected by index, so that the dataset is never copied
+        train_rows = np.arange(len(global_chunks))
+        val_rows = None
+        if args.val_fraction > 0:
+            order = np.random.RandomState(0).permutation(len(global_chunks))
+            n_val = max(1, int(len(global_chunks) * args.val_fraction))
+            val_rows = np.sort(order[:n_val])
+            train_rows = np.sort(order[n_val:])
+            print("Holding out {} of {} chunks".format(n_val, len(global_chunks)))
+        # sample_batch would wait forever for a chunk
+        if len(train_rows) == 0:
+            raise ValueError(
+                "no training chunks left of the %d in %s (val_fraction %g)"
+                % (len(global_chunks), args.dataset, args.val_fraction)
+            )
+        if args.replay_dataset and args.replay_fraction > 0:
+            # Sample older rows to make up replay_fraction of the training rows,
+            # differently on each run but the same on every worker
+            if args.pack_length > 0:
+                replay_chunks, replay_lengths, _ = load_packed(
+                    args.replay_dataset, args.pack_length, eot, n_vocab - 1
+                )
+            else:
+                replay_chunks = load_chunks(
+                    args.replay_dataset, hparams.n_ctx, n_vocab - 1
+                )
+            ratio = args.replay_fraction / (1 - args.replay_fraction)
+            # Rounded up, so that a small update still replays some rows
+            n_replay = min(
+                len(replay_chunks), max(1, int(np.ceil(len(train_rows) * ratio)))
+            )
+            picked = np.sort(
+                np.random.RandomState(counter).choice(
+                    len(replay_chunks), n_replay, replace=False
+                )
+            )
+            train_rows = np.concatenate(
+                [train_rows, len(global_chunks) + np.arange(n_replay)]
+            )
+            global_chunks = np.concatenate([global_chunks, replay_chunks[picked]])
+            if global_lengths is not None:
+                global_lengths = np.concatenate(
+                    [global_lengths, replay_lengths[picked]]
+                )
+            print(
+                "Replaying {} of {} chunks from {}".format(
+                    n_replay, len(replay_chunks), args.replay_dataset
                 )
-                current_token = []
-        global_chunk_index = np.random.permutation(len(global_chunks))
+            )
+        if reducer is not None:
+            # Checked on every worker, so that they all stop
+            if len(train_rows) < reducer.world:
+                raise ValueError(
+                    "%d training chunks cannot be split over %d workers"
+                    % (len(train_rows), reducer.world)
+                )
+            train_rows = train_rows[rank :: reducer.world]
+            if val_rows is not None:
+                val_rows = val_rows[rank :: reducer.world]
+        global_chunk_index = train_rows[np.random.permutation(len(train_rows))]
         global_chunk_step = 0
         print("Training...")
 
-        def sample_feature():
-            nonlocal global_chunks, global_chunk_index, global_chunk_step
-            p_input_ids = []
+        def make_feed(batch):
+            tokens = global_chunks[batch].astype(np.int32)
+            if args.pack_length == 0:
+                return {context: tokens}
 
-            for b in range(args.batch_size):  # FULL-SENTENCES
-                idx = global_chunk_index[global_chunk_step]
-                global_chunk_step += 1
+            # A new document starts after each <|endoftext|>. The padding is
+            # <|endoftext|> too, so each pad token opens a segment of its own,
+            # which the loss mask leaves out
+            segment_ids = np.zeros_like(tokens)
+            np.cumsum(tokens[:, :-1] == eot, axis=1, out=segment_ids[:, 1:])
+            mask = np.arange(args.pack_length) < global_lengths[batch][:, None]
+            return {
+                context: tokens,
+                segments: segment_ids,
+                loss_mask: mask.astype(np.float32),
+            }
+
+        def evaluate():
+            """Return the held-out loss, averaged over all the workers."""
+            totals = np.zeros(2)
+            for start in range(0, len(val_rows), args.eval_batch_size):
+                batch = val_rows[start : start + args.eval_batch_size]
+                totals += sess.run(eval_loss, feed_dict=make_feed(batch))
+            if reducer is not None:
+                totals = reducer.mean(totals)
+            return totals[0] / max(totals[1], 1.0)
+
+        def sample_batch():
+            nonlocal global_chunks, global_chunk_index, global_chunk_step
+            batch = []
+            need = args.batch_size
+            while need > 0:  # FULL-SENTENCES
+                take = min(need, len(global_chunk_index) - global_chunk_step)
+                batch.append(
+                    global_chunk_index[global_chunk_step : global_chunk_step + take]
+                )
+                global_chunk_step += take
+                need -= take
                 if global_chunk_step >= len(global_chunk_index):
                     global_chunk_step = 0
-                    global_chunk_index = np.random.permutation(len(global_chunks))
-                sampled_token = global_chunks[idx]
-                # Make Sequence
-                ids = copy(global_chunks[idx])
-                p_input_ids.append(ids)
+                    global_chunk_index = train_rows[
+                        np.random.permutation(len(train_rows))
+                    ]
+
+            return make_feed(np.concatenate(batch))
 
-            return {context: p_input_ids}
+        if args.prefetch > 0:
+            prefetcher = Prefetcher(sample_batch, args.prefetch)
+            next_batch = prefetcher.get
+        else:
+            prefetcher = None
+            next_batch = sample_batch
 
-        counter = 1
-        counter_path = os.path.join(CHECKPOINT_DIR, args.run_name, "counter")
         hparams_path = os.path.join(CHECKPOINT_DIR, args.run_name, "hparams.json")
-        if os.path.exists(counter_path):
-            # Load the step number if we're resuming a run
-            # Add 1 so we don't immediately try to save again
-            with open(counter_path, "r", encoding="utf-8") as fp:
-                counter = int(fp.read()) + 1
+        adapter_path = os.path.join(CHECKPOINT_DIR, args.run_name, "adapter.json")
 
         maketree(os.path.join(CHECKPOINT_DIR, args.run_name))
 
         def save():
+            if rank != 0:
+                return
             maketree(os.path.join(CHECKPOINT_DIR, args.run_name))
+            checkpointer.wait()
+            report_written()
             print(
                 "Saving",
                 os.path.join(CHECKPOINT_DIR, args.run_name, "model-{}").format(counter),
             )
-            saver.save(
-                sess,
-                os.path.join(CHECKPOINT_DIR, args.run_name, "model"),
-                global_step=counter,
+            files = {
+                counter_path: str(counter) + "\n",
+                hparams_path: json.dumps(
+                    {
+                        "n_vocab": int(hparams.n_vocab),
+                        "n_ctx": int(hparams.n_ctx),
+                        "n_embd": int(hparams.n_embd),
+                        "n_head": int(hparams.n_head),
+                        "n_layer": int(hparams.n_layer),
+                    }
+                ),
+            }
+            if args.lora_rank > 0:
+                # Lets model.restore() merge the adapters into the base model
+                files[adapter_path] = json.dumps(
+                    {
+                        "base_model": args.base_model,
+                        "lora_rank": args.lora_rank,
+                        "lora_alpha": args.lora_alpha,
+                    }
+                )
+            checkpointer.save(counter, files)
+
+        def report_written():
+            if checkpointer is None or checkpointer.written is None:
+                return None
+            (step, write_time) = checkpointer.written
+            checkpointer.written = None
+            print("Wrote model-{} in {:.2f}s".format(step, write_time))
+            return write_time
+
+        world = 1 if reducer is None else reducer.world
+        step_examples = args.batch_size * args.accumulate_steps * world
+
+        if args.trace_steps:
+            trace_start, trace_end = map(int, args.trace_steps.split(":"))
+        else:
+            trace_start = trace_end = 0
+        metrics_log = None
+        if rank == 0:
+            metrics_log = open(
+                os.path.join(CHECKPOINT_DIR, args.run_name, "metrics.jsonl"),
+                "a",
+                encoding="utf-8",
             )
-            with open(counter_path, "w", encoding="utf-8") as fp:
-                fp.write(str(counter) + "\n")
-            with open(hparams_path, "w", encoding="utf-8") as fp:
-                fp.write(
-                    json.dumps(
-                        {
-                            "n_vocab": int(hparams.n_vocab),
-                            "n_ctx": int(hparams.n_ctx),
-                            "n_embd": int(hparams.n_embd),
-                            "n_head": int(hparams.n_head),
-                            "n_layer": int(hparams.n_layer),
-                        }
-                    )
+
+        def run(fetches, feed_dict=None):
+            """sess.run, timed, and traced for the steps in --trace_steps."""
+            nonlocal run_time
+            run_start = time.time()
+            if trace_start <= counter < trace_end:
+                run_metadata = tf.RunMetadata()
+                result = sess.run(
+                    fetches,
+                    feed_dict=feed_dict,
+                    options=tf.RunOptions(trace_level=tf.RunOptions.FULL_TRACE),
+                    run_metadata=run_metadata,
+                )
+                step_stats.extend(run_metadata.step_stats.dev_stats)
+            else:
+                result = sess.run(fetches, feed_dict=feed_dict)
+            run_time += time.time() - run_start
+            return result
+
+        def write_trace():
+            if rank == 0:
+                run_metadata = tf.RunMetadata()
+                run_metadata.step_stats.dev_stats.extend(step_stats)
+                summary_log.add_run_metadata(run_metadata, "step%d" % counter)
+                trace = timeline.Timeline(run_metadata.step_stats)
+                trace_path = os.path.join(
+                    CHECKPOINT_DIR, args.run_name, "trace-%d.json" % counter
                 )
+                with open(trace_path, "w", encoding="utf-8") as fp:
+                    fp.write(trace.generate_chrome_trace_format())
+
+        # Adding an op from here on is a bug that would grow the graph every step
+        sess.graph.finalize()
 
         avg_loss = (0.0, 0.0)
         start_time = time.time()
+        total_wait = 0.0
+        n_steps = 0
+        # Steady-state training time, and the time left out of it
+        train_time = eval_time = checkpoint_time = 0.0
+        train_tokens = 0.0
+        best_val = (float("inf"), 0)
+        bad_evals = 0
 
         try:
             for _ in range(args.num_iter):
+                step_start = time.time()
+                save_time = 0.0
                 if counter % args.save_every == 0:
                     save()
+                    save_time = time.time() - step_start
 
-                (_, v_loss, v_summary) = sess.run(
-                    (opt_apply, loss, summaries), feed_dict=sample_feature()
-                )
+                wait = 0.0
+                run_time = 0.0
+                allreduce_time = 0.0
+                step_stats = []
+                v_loss = 0.0
+                # Tokens trained on, leaving out the padding of packed rows
+                step_tokens = 0.0
+                if args.accumulate_steps > 1:
+                    run(opt_reset)
+                for _ in range(args.accumulate_steps):
+                    wait_start = time.time()
+                    feed = next_batch()
+                    wait += time.time() - wait_start
+                    if args.pack_length > 0:
+                        step_tokens += float(feed[loss_mask].sum())
+                    else:
+                        step_tokens += feed[context].size
+
+                    if args.accumulate_steps > 1:
+                        (_, micro_loss) = run((opt_compute, loss), feed_dict=feed)
+                        v_loss += micro_loss / args.accumulate_steps
+                    elif reducer is not None:
+                        (v_grads, v_loss) = run((grads_flat, loss), feed_dict=feed)
+                    else:
+                        (_, v_loss, v_summary) = run(
+                            (opt_apply, loss, summaries), feed_dict=feed
+                        )
+                if reducer is not None:
+                    if args.accumulate_steps > 1:
+                        v_grads = run(grads_flat)
+                    allreduce_start = time.time()
+                    v_grads = reducer.mean(
+                        np.append(v_grads, np.float32([v_loss, step_tokens]))
+                    )
+                    allreduce_time = time.time() - allreduce_start
+                    v_loss = float(v_grads[-2])
+                    step_tokens = float(v_grads[-1]) * world
+                    run(opt_apply, feed_dict={grads_in: v_grads[:-2]})
+                elif args.accumulate_steps > 1:
+                    run(opt_apply)
+                if args.accumulate_steps > 1 or reducer is not None:
+                    v_summary = tf.Summary(
+                        value=[tf.Summary.Value(tag="loss", simple_value=v_loss)]
+                    )
+                if step_stats:
+                    write_trace()
+                total_wait += wait
+                n_steps += 1
+                step_time = max(time.time() - step_start, 1e-9)
+                # Throughput leaves out the first step, which sets up the graph,
+                # and the checkpoint snapshots
+                if n_steps > 1:
+                    train_time += step_time - save_time
+                    checkpoint_time += save_time
+                    train_tokens += step_tokens
+
+                stop = False
+                if (
+                    val_rows is not None
+                    and args.eval_every > 0
+                    and counter % args.eval_every == 0
+                ):
+                    eval_start = time.time()
+                    val_loss = evaluate()
+                    eval_time += time.time() - eval_start
+                    if val_loss < best_val[0]:
+                        best_val = (val_loss, counter)
+                        bad_evals = 0
+                    else:
+                        bad_evals += 1
+                    stop = 0 < args.early_stop_patience <= bad_evals
+                    if rank == 0:
+                        print(
+                            "[{counter}] val_loss={loss:2.3f} val_ppl={ppl:2.2f} "
+                            "best={best:2.3f}@{best_step}".format(
+                                counter=counter,
+                                loss=val_loss,
+                                ppl=np.exp(val_loss),
+                                best=best_val[0],
+                                best_step=best_val[1],
+                            )
+                        )
+                        summary_log.add_summary(
+                            tf.Summary(
+                                value=[
+                                    tf.Summary.Value(
+                                        tag="val/loss", simple_value=val_loss
+                                    ),
+                                    tf.Summary.Value(
+                                        tag="val/perplexity",
+                                        simple_value=np.exp(val_loss),
+                                    ),
+                                ]
+                            ),
+                            counter,
+                        )
+                        metrics_log.write(
+                            json.dumps(
+                                {
+                                    "step": counter,
+                                    "val_loss": float(val_loss),
+                                    "val_perplexity": float(np.exp(val_loss)),
+                                }
+                            )
+                            + "\n"
+                        )
+                        if stop:
+                            print(
+                                "Early stopping: no improvement in {} evaluations".format(
+                                    bad_evals
+                                )
+                            )
+
+                if rank != 0:
+                    counter = counter + 1
+                    if stop:
+                        break
+                    continue
 
                 summary_log.add_summary(v_summary, counter)
 
                 avg_loss = (avg_loss[0] * 0.99 + v_loss, avg_loss[1] * 0.99 + 1.0)
 
+                metrics = {
+                    "step": counter,
+                    "time": time.time() - start_time,
+                    "loss": float(v_loss),
+                    "avg_loss": float(avg_loss[0] / avg_loss[1]),
+                    "tokens_per_sec": step_tokens / step_time,
+                    "examples_per_sec": step_examples / step_time,
+                    "step_ms": step_time * 1e3,
+                    "input_wait_ms": wait * 1e3,
+                    "run_ms": run_time * 1e3,
+                    "allreduce_ms": allreduce_time * 1e3,
+                    "save_ms": save_time * 1e3,
+                }
+                write_time = report_written()
+                if write_time is not None:
+                    # Background write of the last checkpoint, off the step time
+                    metrics["save_write_ms"] = write_time * 1e3
+                metrics_log.write(json.dumps(metrics) + "\n")
+                metrics_log.flush()
+                summary_log.add_summary(
+                    tf.Summary(
+                        value=[
+                            tf.Summary.Value(tag="perf/" + key, simple_value=value)
+                            for key, value in metrics.items()
+                            if key.endswith(("_per_sec", "_ms"))
+                        ]
+                    ),
+                    counter,
+                )
+
                 print(
-                    "[{counter} | {time:2.2f}] loss={loss:2.2f} avg={avg:2.2f}".format(
+                    "[{counter} | {time:2.2f}] loss={loss:2.2f} avg={avg:2.2f} "
+                    "tokens/s={tps:.0f}".format(
                         counter=counter,
                         time=time.time() - start_time,
                         loss=v_loss,
                         avg=avg_loss[0] / avg_loss[1],
+                        tps=metrics["tokens_per_sec"],
+                    )
+                    + (
+                        " input_wait={:.1f}ms".format(wait * 1e3)
+                        if args.report_input_wait
+                        else ""
                     )
                 )
 
                 counter = counter + 1
-                if args.warmup_steps > 0:
-                    global_step = global_step + 1
+                if stop:
+                    break
             save()
+            if checkpointer is not None:
+                checkpointer.wait()
+            report_written()
         except KeyboardInterrupt:
             print("interrupted")
             save()
+            if checkpointer is not None:
+                checkpointer.wait()
+        finally:
+            if checkpointer is not None:
+                checkpointer.close()
+            if prefetcher is not None:
+                prefetcher.close()
+            if metrics_log is not None:
+                metrics_log.close()
+            if rank == 0 and n_steps > 1:
+                print(
+                    "Trained {steps} steps on {workers} worker(s): "
+                    "{tps:.0f} tokens/s".format(
+                        steps=n_steps,
+                        workers=world,
+                        tps=train_tokens / max(train_time, 1e-9),
+                    )
+                    + (
+                        ", not counting {:.2f}s of evaluation and {:.2f}s of "
+                        "checkpointing".format(eval_time, checkpoint_time)
+                        if eval_time or checkpoint_time
+                        else ""
+                    )
+                )
+            if rank == 0:
+                # ru_maxrss is in kilobytes on Linux
+                print(
+                    "Peak memory: {:.0f} MB (checkpoint policy {})".format(
+                        resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024,
+                        args.checkpoint_policy,
+                    )
+                )
+                if args.report_input_wait:
+                    elapsed = max(time.time() - start_time, 1e-9)
+                    print(
+                        "Waited {wait:.2f}s for input ({pct:.1f}% of {time:.2f}s)".format(
+                            wait=total_wait,
+                            pct=100 * total_wait / elapsed,
+                            time=elapsed,
+                        )
+                    )
+
+
+def _train_worker(args, rank, path, barrier):
+    train(args, rank, SharedAllReduce(path, rank, args.num_workers, barrier))
+
+
+def train_data_parallel(args):
+    """Run args.num_workers training processes that average their gradients
+    through shared memory."""
+    ctx = multiprocessing.get_context("spawn")
+    barrier = ctx.Barrier(args.num_workers)
+    shm_dir = tempfile.mkdtemp(dir="/dev/shm" if os.path.isdir("/dev/shm") else None)
+    path = os.path.join(shm_dir, "grads")
+    workers = [
+        ctx.Process(target=_train_worker, args=(args, rank, path, barrier))
+        for rank in range(args.num_workers)
+    ]
+    try:
+        for w in workers:
+            w.start()
+        while any(w.is_alive() for w in workers):
+            if any(w.exitcode not in (None, 0) for w in workers):
+                # Release the workers blocked on the failed one
+                barrier.abort()
+            time.sleep(1)
+    finally:
+        for w in workers:
+            w.join()
+        shutil.rmtree(shm_dir, ignore_errors=True)
+    if any(w.exitcode != 0 for w in workers):
+        raise RuntimeError("a training worker exited abnormally")
+
+
+def main():
+    args = parser.parse_args()
+    if args.num_workers > 1:
+        train_data_parallel(args)
+    else:
+        train(args)
 
 
 if __name__ == "__main__":
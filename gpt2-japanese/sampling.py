@@ -42,6 +42,10 @@ def top_p_logits(logits, p):
         )
 
 
+def _round_up(n, multiple):
+    return (n + multiple - 1) // multiple * multiple
+
+
 def sample_sequence(
     *,
     hparams,
@@ -52,18 +56,32 @@ def sample_sequence(
     context=None,
     temperature=1,
     top_k=0,
-    top_p=0.0
+    top_p=0.0,
+    dtype=tf.float32,
+    xla=False,
+    xla_bucket=64
 ):
+    """With `xla`, the sampling loop is compiled as a whole with XLA. The
+    past and the tokens are kept in buffers preallocated for the whole
+    sequence so the loop variables have fixed shapes, and the context and
+    buffer lengths are rounded up to multiples of `xla_bucket` tokens, which
+    bounds the compilations across contexts and lengths."""
     if start_token is None:
         assert context is not None, "Specify exactly one of start_token and context!"
     else:
         assert context is None, "Specify exactly one of start_token and context!"
         context = tf.fill([batch_size, 1], start_token)
 
-    def step(hparams, tokens, past=None):
-        lm_output = model.model(
-            hparams=hparams, X=tokens, past=past, reuse=tf.AUTO_REUSE
-        )
+    def step(hparams, tokens, past=None, past_length=None):
+        with model.jit_scope(xla):
+            lm_output = model.model(
+                hparams=hparams,
+                X=tokens,
+                past=past,
+                reuse=tf.AUTO_REUSE,
+                dtype=dtype,
+                past_length=past_length,
+            )
 
         logits = lm_output["logits"][:, :, : hparams.n_vocab]
         presents = lm_output["present"]
@@ -77,78 +95,92 @@ def sample_sequence(
         # Don't feed the last context token -- leave that to the loop below
         # TODO: Would be slightly faster if we called step on the entire context,
         # rather than leaving the last token transformer calculation to the while loop.
-        context_output = step(hparams, context[:, :-1])
-
-        def body1(past, prev, output):
-            next_outputs = step(hparams, prev[:, tf.newaxis], past=past)
-            logits = next_outputs["logits"][:, -1, :] / tf.to_float(temperature)
-            if top_p > 0.0:
-                logits = top_p_logits(logits, p=top_p)
-            else:
-                logits = top_k_logits(logits, k=top_k)
-            samples = tf.multinomial(
-                logits[:, :-1], num_samples=1, output_dtype=tf.int32
+        past_length = tf.shape(context)[1] - 1
+        if xla:
+            # Right padding does not change the outputs of the real tokens,
+            # and the loop overwrites its entries in the cache
+            padded_length = tf.minimum(
+                _round_up(past_length, xla_bucket), hparams.n_ctx
             )
-            return [
-                tf.concat([past, next_outputs["presents"]], axis=-2),
-                tf.squeeze(samples, axis=[1]),
-                tf.concat([output, samples], axis=1),
-            ]
-
-        def body2(past, prev, output):
-            next_outputs = step(hparams, prev[:, tf.newaxis], past=past)
+            context_output = step(
+                hparams,
+                tf.pad(context[:, :-1], [[0, 0], [0, padded_length - past_length]]),
+            )
+            cache_length = _round_up(past_length + length, xla_bucket)
+            past = tf.pad(
+                context_output["presents"],
+                [[0, 0]] * 4 + [[0, cache_length - padded_length], [0, 0]],
+            )
+            # The token after the last one in the cache is at past_length + 1
+            output = tf.pad(context, [[0, 0], [0, cache_length - past_length]])
+        else:
+            context_output = step(hparams, context[:, :-1])
+            past = context_output["presents"]
+            output = context
+
+        def body(past, past_length, prev, output, allow_last):
+            if xla:
+                next_outputs = step(
+                    hparams, prev[:, tf.newaxis], past=past, past_length=past_length
+                )
+                # Write the new entries at past_length
+                slot = tf.one_hot(past_length, tf.shape(past)[-2], dtype=past.dtype)
+                slot = slot[:, tf.newaxis]
+                past = past * (1 - slot) + next_outputs["presents"] * slot
+            else:
+                next_outputs = step(hparams, prev[:, tf.newaxis], past=past)
+                past = tf.concat([past, next_outputs["presents"]], axis=-2)
             logits = next_outputs["logits"][:, -1, :] / tf.to_float(temperature)
             if top_p > 0.0:
                 logits = top_p_logits(logits, p=top_p)
             else:
                 logits = top_k_logits(logits, k=top_k)
+            if not allow_last:
+                logits = logits[:, :-1]
             samples = tf.multinomial(logits, num_samples=1, output_dtype=tf.int32)
-            return [
-                tf.concat([past, next_outputs["presents"]], axis=-2),
-                tf.squeeze(samples, axis=[1]),
-                tf.concat([output, samples], axis=1),
-            ]
+            if xla:
+                slot = tf.one_hot(past_length + 1, tf.shape(output)[1], dtype=tf.int32)
+                output = output * (1 - slot) + samples * slot
+            else:
+                output = tf.concat([output, samples], axis=1)
+            return [past, past_length + 1, tf.squeeze(samples, axis=[1]), output]
+
+        def body1(past, past_length, prev, output):
+            return body(past, past_length, prev, output, allow_last=False)
+
+        def body2(past, past_length, prev, output):
+            return body(past, past_length, prev, output, allow_last=True)
 
         def cond(*args):
             return True
 
-        if min_length > 0:
-            _, _, context = tf.while_loop(
+        shape_invariants = [
+            tf.TensorShape(model.past_shape(hparams=hparams, batch_size=batch_size)),
+            tf.TensorShape([]),
+            tf.TensorShape([batch_size]),
+            tf.TensorShape([batch_size, None]),
+        ]
+        prev = context[:, -1]
+        with model.jit_scope(xla):
+            if min_length > 0:
+                past, past_length, prev, output = tf.while_loop(
+                    cond=cond,
+                    body=body1,
+                    maximum_iterations=min_length,
+                    loop_vars=[past, past_length, prev, output],
+                    shape_invariants=shape_invariants,
+                    back_prop=False,
+                )
+
+            _, _, _, tokens = tf.while_loop(
                 cond=cond,
-                body=body1,
-                maximum_iterations=min_length,
-                loop_vars=[
-                    context_output["presents"],
-                    context[:, -1],
-                    context,
-                ],
-                shape_invariants=[
-                    tf.TensorShape(
-                        model.past_shape(hparams=hparams, batch_size=batch_size)
-                    ),
-                    tf.TensorShape([batch_size]),
-                    tf.TensorShape([batch_size, None]),
-                ],
+                body=body2,
+                maximum_iterations=length - min_length,
+                loop_vars=[past, past_length, prev, output],
+                shape_invariants=shape_invariants,
                 back_prop=False,
             )
 
-        _, _, tokens = tf.while_loop(
-            cond=cond,
-            body=body2,
-            maximum_iterations=length - min_length,
-            loop_vars=[
-                context_output["presents"],
-                context[:, -1],
-                context,
-            ],
-            shape_invariants=[
-                tf.TensorShape(
-                    model.past_shape(hparams=hparams, batch_size=batch_size)
-                ),
-                tf.TensorShape([batch_size]),
-                tf.TensorShape([batch_size, None]),
-            ],
-            back_prop=False,
-        )
-
+        if xla:
+            tokens = tokens[:, : tf.shape(context)[1] + length]
         return tokens
@@ -7,6 +7,8 @@ import time
 import random
 import glob
 import argparse
+import hashlib
+import tempfile
 import subprocess
 from datetime import datetime
 from dataclasses import dataclass
@@ -22,6 +24,14 @@ load_dotenv()
 
 NUM_TWEETS_PER_DAY = 48
 
+# Reject generated tweets sharing this many consecutive tokens with the
+# training data
+MAX_COPIED_TOKENS = 20
+
+# Content hashes of the source files a fine-tuned model has been trained on,
+# in its run directory
+TRAINED_FILES = "trained_files.txt"
+
 
 @dataclass
 class AuthenticationInfo:
@@ -32,36 +42,162 @@ class AuthenticationInfo:
     access_token_secret: str = ("",)
 
 
+def list_texts(src_dir: str) -> list[str]:
+    return sorted(
+        os.path.relpath(path, src_dir)
+        for path in glob.glob(f"{src_dir}/**/*.txt", recursive=True)
+    )
+
+
+def hash_texts(src_dir: str, texts: list[str]) -> dict[str, str]:
+    hashes = {}
+    for text in texts:
+        h = hashlib.sha1()
+        with open(os.path.join(src_dir, text), "rb") as f:
+            for block in iter(lambda: f.read(1 << 20), b""):
+                h.update(block)
+        hashes[text] = h.hexdigest()
+    return hashes
+
+
+def write_trained_files(model: str, hashes: dict[str, str]) -> None:
+    # One "<sha1>  <file>" line per file, like sha1sum
+    with open(f"{model}/{TRAINED_FILES}", "w", encoding="utf-8") as f:
+        f.write("".join(f"{h}  {text}\n" for text, h in hashes.items()))
+
+
 def finetune(
     src_dir: str = "sample_texts",
     dst_file: str = "finetune",
     run_name: str = "gpt2ja-finetune-small",
     num_iter: int = 400,
+    cache_dir: str = "encode_cache",
+    save_optimizer: bool = False,
 ) -> None:
 
-    # Encode a dataset
+    # Hashed before encoding, so that a file rewritten meanwhile counts as new
+    hashes = hash_texts(src_dir, list_texts(src_dir))
+
+    # Encode a dataset, reusing the tokens of files encoded in earlier runs
     subprocess.run(
-        f"python3.9 gpt2-japanese/encode_bpe.py --src_dir {src_dir} --dst_file {dst_file}",
+        f"python3.9 gpt2-japanese/encode_bpe.py \
+        --src_dir {src_dir} \
+        --dst_file {dst_file} \
+        --cache_dir {cache_dir}",
         shell=True,
     )
 
-    # Fine-Tune
+    # Fine-Tune; the optimizer state is only needed to resume incrementally
+    optimizer = "--save_optimizer" if save_optimizer else ""
     subprocess.run(
         f"python3.9 gpt2-japanese/run_finetune.py \
         --num_iter {num_iter} \
         --base_model gpt2ja-small \
-        --dataset {dst_file}.npz \
-        --run_name {run_name}",
+        --dataset {dst_file}.json \
+        --run_name {run_name} \
+        {optimizer}",
+        shell=True,
+    )
+
+    # Index the training n-grams, to reject generated copies of training tweets
+    subprocess.run(
+        f"python3.9 gpt2-japanese/ngram_index.py build \
+        --dataset {dst_file}.json \
+        --output checkpoints/{run_name}/ngrams.npz",
         shell=True,
     )
 
     # Remove interim files
-    subprocess.run(f"rm {dst_file}.npz", shell=True)
-    subprocess.run("for i in $(seq 0 7); do rm tmp$i.pkl; done", shell=True)
+    subprocess.run(f"rm -f {dst_file}.json {dst_file}.*.tokens", shell=True)
+
+    write_trained_files(f"checkpoints/{run_name}", hashes)
 
     return None
 
 
+def finetune_incremental(
+    model: str,
+    src_dir: str = "sample_texts",
+    dst_file: str = "increment",
+    num_iter: int = 100,
+    replay_fraction: float = 0.25,
+    cache_dir: str = "encode_cache",
+) -> bool:
+    """Continue fine-tuning `model` on the files of `src_dir` it has not
+    been trained on, mixed with a sample of the older ones. Files are told
+    apart by content, so a file rewritten since counts as new.
+
+    Returns False, without training, when there is no new file.
+    """
+
+    texts = list_texts(src_dir)
+    hashes = hash_texts(src_dir, texts)
+    record = f"{model}/{TRAINED_FILES}"
+
+    # Models fine-tuned before the record existed were trained on all files
+    if not os.path.exists(record):
+        write_trained_files(model, hashes)
+        return False
+
+    with open(record, encoding="utf-8") as f:
+        trained = {line.split()[0] for line in f if line.strip()}
+    new = [text for text in texts if hashes[text] not in trained]
+    if not new:
+        return False
+    old = [text for text in texts if hashes[text] in trained]
+
+    # Link the new and the older files into two source directories; the
+    # older ones are encoded from the cache
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        for name, files in (("new", new), ("old", old)):
+            if not files:
+                continue
+            for text in files:
+                link = os.path.join(tmp_dir, name, text)
+                os.makedirs(os.path.dirname(link), exist_ok=True)
+                os.symlink(os.path.abspath(os.path.join(src_dir, text)), link)
+
+            subprocess.run(
+                f"python3.9 gpt2-japanese/encode_bpe.py \
+                --src_dir {tmp_dir}/{name} \
+                --dst_file {dst_file}-{name} \
+                --cache_dir {cache_dir}",
+                shell=True,
+            )
+
+    # Resume from the last checkpoint, with its optimizer state and counter
+    replay = f"--replay_dataset {dst_file}-old.json" if old else ""
+    subprocess.run(
+        f"python3.9 gpt2-japanese/run_finetune.py \
+        --num_iter {num_iter} \
+        --base_model gpt2ja-small \
+        --dataset {dst_file}-new.json \
+        --run_name {os.path.basename(model)} \
+        --resume \
+        --save_optimizer \
+        {replay} \
+        --replay_fraction {replay_fraction}",
+        shell=True,
+        check=True,
+    )
+
+    # The index covers the new and the older training data
+    datasets = f"{dst_file}-new.json" + (f" {dst_file}-old.json" if old else "")
+    subprocess.run(
+        f"python3.9 gpt2-japanese/ngram_index.py build \
+        --dataset {datasets} \
+        --output {model}/ngrams.npz",
+        shell=True,
+    )
+
+    # Remove interim files
+    subprocess.run(f"rm -f {dst_file}-*.json {dst_file}-*.tokens", shell=True)
+
+    write_trained_files(model, hashes)
+
+    return True
+
+
 def generate(
     model: str,
     num_generate: int = 1,
@@ -93,6 +229,30 @@ def generate(
     return generated
 
 
+def is_copied(model: str, text_file: str = "dist/dist.txt") -> bool:
+
+    # Models fine-tuned before the index existed are not checked
+    index = f"{model}/ngrams.npz"
+    if not os.path.exists(index):
+        return False
+
+    result = subprocess.run(
+        f"python3.9 gpt2-japanese/ngram_index.py check \
+        {text_file} \
+        --index {index}",
+        shell=True,
+        capture_output=True,
+    )
+
+    # A failed check does not stop posting; the text is just not checked
+    overlap = result.stdout.decode().split("\t")[0]
+    if result.returncode != 0 or not overlap.isdigit():
+        print(f"Could not check {text_file} against {index}")
+        return False
+
+    return int(overlap) >= MAX_COPIED_TOKENS
+
+
 def post_tweet(
     client: tweepy.Client,
     text: str,
@@ -133,6 +293,8 @@ def create_custom_tweets(
     no_post: bool = False,
     num_iter: int = 400,
     is_google_colab: bool = False,
+    incremental: bool = False,
+    incremental_iter: int = 100,
 ) -> tuple[str, float] | None:
 
     client = tweepy.Client(
@@ -154,6 +316,7 @@ def create_custom_tweets(
                 dst_file=f"{today}-finetune",
                 run_name=f"gpt2ja-{today}-finetune-small",
                 num_iter=num_iter,
+                save_optimizer=incremental,
             )
             model = f"./checkpoints/gpt2ja-{today}-finetune-small"
     else:
@@ -162,10 +325,15 @@ def create_custom_tweets(
                 dst_file=f"{model}-finetune",
                 run_name=model,
                 num_iter=num_iter,
+                save_optimizer=incremental,
             )
 
         model = f"./checkpoints/{model}"
 
+    # Take in the files downloaded since the model was last trained
+    if incremental:
+        finetune_incremental(model, num_iter=incremental_iter)
+
     while True:
         generated_text = generate(
             model=model,
@@ -174,6 +342,10 @@ def create_custom_tweets(
             output_file="dist/dist.txt",
         )
 
+        # Skip tweets copied from the training data
+        if is_copied(model, "dist/dist.txt"):
+            continue
+
         if not is_google_colab:
             score = (
                 subprocess.run(
@@ -235,6 +407,19 @@ def main():
         help="The number of iteration steps",
         dest="num_iter",
     )
+    argparser.add_argument(
+        "--incremental",
+        action="store_true",
+        help="Before each tweet, continue fine-tuning the model on new files "
+        "of sample_texts, replaying a sample of the older ones",
+    )
+    argparser.add_argument(
+        "--incremental_iter",
+        type=int,
+        default=100,
+        help="The number of iteration steps of an incremental update",
+        dest="incremental_iter",
+    )
     args = argparser.parse_args()
 
     # Get auth tokens from .env file
@@ -256,6 +441,8 @@ def main():
                 model=args.model,
                 no_post=args.no_post,
                 num_iter=args.num_iter,
+                incremental=args.incremental,
+                incremental_iter=args.incremental_iter,
             )
 
             # Sleep 30 min
@@ -273,6 +460,8 @@ def main():
                 no_post=args.no_post,
                 is_google_colab=args.is_google_colab,
                 num_iter=args.num_iter,
+                incremental=args.incremental,
+                incremental_iter=args.incremental_iter,
             )
 
             if args.num_generation - i != 1:
@@ -1,13 +1,21 @@
 #!/bin/bash
 
 # Encode
-python gpt2-japanese/encode_bpe.py --src_dir sample_texts --dst_file finetune
+python gpt2-japanese/encode_bpe.py \
+    --src_dir sample_texts \
+    --dst_file finetune \
+    --cache_dir encode_cache
 
 # Fine-Tuning
 python gpt2-japanese/run_finetune.py \
     --base_model gpt2ja-small \
-    --dataset finetune.npz \
+    --dataset finetune.json \
     --run_name gpt2ja-finetune-small
 
-# Remove pickle files
-for i in "$(seq 0 7)"; do rm tmp$i.pkl; done
+# Index the training n-grams, to reject generated copies of training tweets
+python gpt2-japanese/ngram_index.py build \
+    --dataset finetune.json \
+    --output checkpoints/gpt2ja-finetune-small/ngrams.npz
+
+# Remove token shards
+rm -f finetune.json finetune.*.tokens